@@ -4,9 +4,74 @@ STATE_FILE = ""
 DAILY_RUN_HOUR = 3
 DAEMON_INTERVAL = 30
 
+# Start daemon scans when log files are written (inotify, Linux only) instead of every DAEMON_INTERVAL.
+# Waits DAEMON_DEBOUNCE seconds for writes to settle but no more than DAEMON_MAX_LATENCY, and scans
+# at least every DAEMON_IDLE_INTERVAL (keep it under an hour so DAILY_RUN_HOUR is not missed)
+DAEMON_INOTIFY = False
+DAEMON_DEBOUNCE = 2
+DAEMON_MAX_LATENCY = 10
+DAEMON_IDLE_INTERVAL = 600
+
+# State file encoding: "json" (compact), "zlib" (compressed) or "pretty" (indented json, the old format).
+# Files are replaced atomically, old state files are read in any format and converted on the next save.
+STATE_FORMAT = "json"
+
+# Keep readers/monitors loaded between daemon scans, state is only saved every STATE_CHECKPOINT_INTERVAL seconds and at shutdown.
+# Monitors are only created (and init_cfg called) once, anything they keep on self carries over to the next scan.
+# Monitors that build things up per scan should reset them in an init_scan() method, it's called before every scan.
+PERSISTENT_DAEMON = False
+STATE_CHECKPOINT_INTERVAL = 300
+
+# Parse reader files in this many worker processes (readers can override with "workers"), 0 parses in the main process
+READER_WORKERS = 0
+READER_CHUNK_SIZE = 16777216
+
+# Memory map reader files and prefilter lines as bytes, only decoding the lines that are parsed (readers can override with "mmap")
+READER_MMAP = False
+
+# Rows are handed to monitors in chunks of this many, monitors can define check_batch(rows) to take a whole chunk
+CHECK_BATCH_SIZE = 2000
+
+# Split monitors across this many worker processes, each one checks, completes, emails and saves its own monitors
+# (a worker that fails disables its monitors for that scan and is started again for the next one)
+MONITOR_WORKERS = 0
+MONITOR_BATCH_SIZE = 2000
+
+# Save monitor dstate changes to an append-only journal (<monitor>.journal) instead of rewriting the whole
+# state file every scan, the journal is folded back into the state file when it's bigger than this many bytes.
+# Monitors whose dlists/ddicts hold dicts or lists (not compact or sqlite ones) still save the whole state, those
+# values can be changed in place without it being journaled.
+STATE_JOURNAL = False
+STATE_JOURNAL_COMPACT_SIZE = 64*1024*1024
+
+# Monitor sqlstate inserts are written in batches of this many rows, or after this many seconds (committed once, when the monitor is saved)
+SQLSTATE_FLUSH_SIZE = 1000
+SQLSTATE_FLUSH_INTERVAL = 5
+# Open monitor sqlite dbs in WAL mode
+SQLSTATE_WAL = True
+# Keep the sqlstate tables of monitors that set sqlstate_shared = True in one db, committed once per scan. The db is
+# SQLSTATE_SHARED_PATH, logalerts.sqlite in STATE_ROOT_PATH by default. Their tables are named <monitor>__<table>, so a
+# monitor should only set sqlstate_shared if its queries name tables with self.sqlstate.table(name). The first time a
+# monitor uses the shared db, its <monitor>.sqlite is copied in (the file itself is left alone and no longer used).
+SQLSTATE_SHARED = False
+# Seconds to wait when another monitor worker process is writing to the db
+SQLSTATE_BUSY_TIMEOUT = 60
+
+# Expired sqlstate rows are deleted every scan, in chunks of SQLSTATE_PURGE_CHUNK rows
+SQLSTATE_PURGE_CHUNK = 10000
+
+# Default storage for monitor dlists, "list", "compact" (column storage, uses much less memory for big lists)
+# or "sqlite" (dlists and ddicts are kept in the monitor's sqlite db and queried there instead of loaded into memory)
+DYNAMICSTATE_STORAGE = "list"
+
 SYSLOG_HUP_CMD = "/usr/bin/systemctl kill -s HUP rsyslog.service"
 
 MAILSERVER = ""
+# Monitor emails are sent over one SMTP connection per scan, opened again every SMTP_BATCH_SIZE messages
+# and after connection errors. Give up on the mail server after SMTP_TIMEOUT seconds, a server that can't be
+# reached isn't tried again until the next scan (the emails stay queued).
+SMTP_BATCH_SIZE = 100
+SMTP_TIMEOUT = 30
 FROM_ADDRESS = ""
 ERRORS_FROM_ADDRESS = ""
 EMAIL_ERRORS_TO = ""
@@ -21,6 +86,12 @@ DEBUG_MODULES = False
 RUNLOG_PATH = ""
 DEBUGLOG_PATH = ""
 ERRORLOG_PATH = ""
+# Log lines are written by a background thread that keeps the log files open, flushing every LOG_FLUSH_LINES
+# lines or LOG_FLUSH_INTERVAL seconds and at the end of each scan. Rotated log files are reopened.
+LOG_BUFFERED = True
+LOG_QUEUE_SIZE = 10000
+LOG_FLUSH_LINES = 1000
+LOG_FLUSH_INTERVAL = 1
 
 # You must fill out enabled monitors and readers. Config is optional, or supply empty dict
 ENABLED_MONITORS = {
@@ -30,6 +101,7 @@ ENABLED_MONITORS = {
 #    "monitor_dc_kerberos_scanning"      : {
 #        "email_to"  :   "alertme@domain.com"
 #    }
+#    Set "dstate_storage" : "sqlite" (or "list"/"compact") to override DYNAMICSTATE_STORAGE for one monitor
 }
 
 # Use this to only enable readers, if empty or missing, no readers are enabled
@@ -37,6 +109,12 @@ ENABLED_READERS = {
 #    "reader_dclogs"         : {
 #        "files" : ["/var/log/user.log"]
 #    }
+#    Set "mode" : "tail" to read the files in place from the last saved offset instead of moving them and HUPing syslog
+#    "files" can use glob patterns, gzip/bz2/xz compressed files are detected and read directly. Compressed files are
+#    always read in place (never moved or deleted) and only once. An archive that logrotate compressed from a file that was
+#    already tailed is read from where that file was left. It's recognised by a checksum of everything that was read from
+#    that file, so tailed files need their state kept until they are compressed (ex: don't change the glob between
+#    rotations). Archives that don't match a tailed file are read whole.
 }
 
 
@@ -1,74 +1,315 @@
+import os,sys
 import time
 import json
+import math
+import base64
+import hashlib
+from array import array
 from collections import OrderedDict
+from collections import deque
+sys.path.append(os.path.join(os.path.dirname(__file__), "../"))
+import config
+
+# Default storage for dlists: "list" (DynamicList), "compact" (CompactDynamicList) or "sqlite"
+# (SQLiteDynamicList, ddicts are also kept in sqlite then)
+try:
+    DYNAMICSTATE_STORAGE = config.DYNAMICSTATE_STORAGE
+except AttributeError:
+    DYNAMICSTATE_STORAGE = "list"
+
+# Values a monitor can change in place, without the change going through the dlist or ddict
+MUTABLE_TYPES = (dict, list)
 
 class DynamicState:
 
-    def __init__(self, data):
+    # sqlstate: the monitor's SQLState, where "sqlite" lists and dicts are kept
+    def __init__(self, data, sqlstate=None):
         self.dlists = {}
         self.ddicts = {}       
+        self.journal = None
+        self.sqlstate = sqlstate
+        # Default storage for this state's lists and dicts, None uses DYNAMICSTATE_STORAGE
+        self.storage = None
         if data.get("lists"):
             for dlist in data["lists"]:
-                expire = data["lists"][dlist]["expire"]
-                self.dlists[dlist] = DynamicList(data["lists"][dlist]["data"], expire)
+                saved = data["lists"][dlist]
+                self.dlists[dlist] = self.__new_dlist(dlist, saved["data"], saved["expire"], saved.get("indexes"), saved.get("storage", "list"))
         else:
             self.dlists = {}
 
         if data.get("dicts"):
             for ddict in data["dicts"]:
-                expire = data["dicts"][ddict]["expire"]
-                self.ddicts[ddict] = DynamicDict(data["dicts"][ddict]["data"], expire)
+                saved = data["dicts"][ddict]
+                self.ddicts[ddict] = self.__new_ddict(ddict, saved["data"], saved["expire"], saved.get("storage", "dict"))
         else:
             self.ddicts = {}
 
+        self.counters = {}
+        if data.get("counters"):
+            for counter in data["counters"]:
+                saved = data["counters"][counter]
+                self.counters[counter] = SlidingCounter(saved["data"], saved["expire"], saved["bucket_size"])
+
+        self.sketches = {}
+        if data.get("sketches"):
+            for sketch in data["sketches"]:
+                saved = data["sketches"][sketch]
+                self.sketches[sketch] = SKETCH_TYPES[saved["type"]](saved["data"], **saved["settings"])
+
+    def __new_dlist(self, name, data, expire, indexes, storage):
+        if storage == "sqlite":
+            if self.sqlstate is None:
+                raise ValueError("dlist "+name+" uses sqlite storage, but there is no sqlstate")
+            return SQLiteDynamicList(self.sqlstate, name, data, expire, indexes)
+        return new_dlist(data, expire, indexes, storage)
+
+    def __new_ddict(self, name, data, expire, storage):
+        if storage == "sqlite":
+            if self.sqlstate is None:
+                raise ValueError("ddict "+name+" uses sqlite storage, but there is no sqlstate")
+            return SQLiteDynamicDict(self.sqlstate, name, data, expire)
+        return DynamicDict(data, expire)
+
+    def __default_storage(self):
+        if self.storage is not None:
+            return self.storage
+        return DYNAMICSTATE_STORAGE
+
+
+    # Start recording every change (see Logmonitor state journal), changes are [kind, name, method, args]
+    def start_journal(self):
+        self.journal = []
+        for name in self.dlists:
+            self.dlists[name].journal = (self.journal, name)
+        for name in self.ddicts:
+            self.ddicts[name].journal = (self.journal, name)
+        for name in self.counters:
+            self.counters[name].journal = (self.journal, name)
+        for name in self.sketches:
+            self.sketches[name].journal = (self.journal, name)
+
+    # Returns the changes recorded since the last call
+    def take_journal(self):
+        if self.journal is None:
+            return []
+        changes = list(self.journal)
+        del(self.journal[:])
+        return changes
+
+    # Same as take_journal, but the changes are kept until take_journal is called
+    def peek_journal(self):
+        if self.journal is None:
+            return []
+        return list(self.journal)
+
+    # True when a list or dict holds dicts or lists, changes made to those in place aren't journaled
+    def has_mutable_values(self):
+        for name in self.dlists:
+            if self.dlists[name].mutable:
+                return True
+        for name in self.ddicts:
+            if self.ddicts[name].mutable:
+                return True
+        return False
+
+    # Apply a change from the journal, when loading state
+    def replay(self, change):
+        kind, name, method, args = change
+        if kind == "state":
+            getattr(self, method)(*args)
+        elif kind == "list":
+            getattr(self.dlists[name], method)(*args)
+        elif kind == "dict":
+            getattr(self.ddicts[name], method)(*args)
+        elif kind == "counter":
+            getattr(self.counters[name], method)(*args)
+        elif kind == "sketch":
+            getattr(self.sketches[name], method)(*args)
+
+    def __record(self, method, args, obj):
+        if self.journal is not None:
+            self.journal.append(["state", None, method, args])
+            obj.journal = (self.journal, args[0])
+
+    # Expire old data, normally done when the state is loaded at the start of a scan
+    def purge(self):
+        for dlist in self.dlists:
+            self.dlists[dlist].purge()
+        for ddict in self.ddicts:
+            self.ddicts[ddict].purge()
+        for counter in self.counters:
+            self.counters[counter].purge()
+        for sketch in self.sketches:
+            self.sketches[sketch].purge()
 
     def dlist(self, name):
         return self.dlists.get(name)
     
-    def init_dlist(self, name, expire=3600):
-        if self.dlists.get(name) is None:
-            self.dlists[name] = DynamicList([], expire)
-        elif self.dlists[name].expire != expire:
-            self.dlists[name].expire = expire
-            self.dlists[name].purge()
-
-    def init_ddict(self, name, expire=3600):
-        if self.ddicts.get(name) is None:
-            self.ddicts[name] = DynamicDict({}, expire)
-        elif self.ddicts[name].expire != expire:
-            self.ddicts[name].expire = expire
-            self.ddicts[name].purge()
+    # indexes: list of value keys to keep hash indexes on, makes filter/counts/unique/touch on
+    # those keys lookups instead of scanning the whole list (see IndexedDynamicList)
+    # storage: "list", "compact" (see CompactDynamicList) or "sqlite" (see SQLiteDynamicList),
+    # defaults to the state's storage or DYNAMICSTATE_STORAGE. Compact lists have no indexes, a list
+    # with indexes is kept as a "list" when compact is only the default.
+    def init_dlist(self, name, expire=3600, indexes=None, storage=None):
+        if storage == "compact" and indexes:
+            raise ValueError("dlist "+name+" has indexes, compact storage can't index lists")
+        if storage is None:
+            storage = self.__default_storage()
+            if storage == "compact" and indexes:
+                storage = "list"
+
+        current = self.dlists.get(name)
+        if current is None:
+            self.dlists[name] = self.__new_dlist(name, [], expire, indexes, storage)
+        elif current.storage != storage or (indexes or None) != current.indexes:
+            # Storage or indexes changed, rebuild the list with the existing data
+            self.dlists[name] = self.__new_dlist(name, current.data, expire, indexes, storage)
+            if current.storage == "sqlite" and storage != "sqlite":
+                current.drop()
+        elif current.expire != expire:
+            current.expire = expire
+            current.purge()
+        else:
+            return
+        self.__record("init_dlist", [name, expire, indexes, storage], self.dlists[name])
+
+    # storage: "dict" or "sqlite" (see SQLiteDynamicDict), defaults to sqlite when the state's storage is
+    def init_ddict(self, name, expire=3600, storage=None):
+        if storage is None:
+            storage = "sqlite" if self.__default_storage() == "sqlite" else "dict"
+
+        current = self.ddicts.get(name)
+        if current is None:
+            self.ddicts[name] = self.__new_ddict(name, {}, expire, storage)
+        elif current.storage != storage:
+            self.ddicts[name] = self.__new_ddict(name, current.data, expire, storage)
+            if current.storage == "sqlite":
+                current.drop()
+        elif current.expire != expire:
+            current.expire = expire
+            current.purge()
+        else:
+            return
+        self.__record("init_ddict", [name, expire, storage], self.ddicts[name])
+
+    # expire: seconds counted, bucket_size: seconds per bucket, counts expire a whole bucket at a time
+    def init_counter(self, name, expire=3600, bucket_size=60):
+        current = self.counters.get(name)
+        if current is None:
+            self.counters[name] = SlidingCounter([], expire, bucket_size)
+        elif current.bucket_size != bucket_size:
+            # Buckets can't be split, start over
+            self.counters[name] = SlidingCounter([], expire, bucket_size)
+        elif current.expire != expire:
+            current.expire = expire
+            current.purge()
+        else:
+            return
+        self.__record("init_counter", [name, expire, bucket_size], self.counters[name])
+
+    def counter(self, name):
+        return self.counters.get(name)
+
+    # Distinct values per key over the last expire seconds, in a fixed amount of memory per key
+    # (see DistinctCounter). error: relative error of the counts
+    def init_distinct(self, name, expire=3600, error=0.02, windows=4):
+        self.__init_sketch(name, "distinct", {"expire": expire, "error": error, "windows": windows})
+
+    # Approximate counts and the most frequent keys over the last expire seconds (see FrequencySketch).
+    # Counts are over by at most error * the total count, with the given confidence.
+    def init_frequency(self, name, expire=3600, error=0.005, confidence=0.99, heavy_hitters=100, windows=4):
+        self.__init_sketch(name, "frequency", {"expire": expire, "error": error, "confidence": confidence,
+            "heavy_hitters": heavy_hitters, "windows": windows})
+
+    # Set of keys seen in the last ttl seconds for deduplicating alerts (see SeenFilter), capacity: keys
+    # expected per ttl, error_rate: chance of a key that wasn't added being reported as seen
+    def init_seen(self, name, ttl=86400, capacity=100000, error_rate=0.001, windows=4):
+        self.__init_sketch(name, "seen", {"expire": ttl, "capacity": capacity, "error_rate": error_rate, "windows": windows})
+
+    def __init_sketch(self, name, sketch_type, settings):
+        current = self.sketches.get(name)
+        if current is not None and current.sketch_type == sketch_type and current.settings() == settings:
+            return
+        # The sketches can't be resized, changed settings start over
+        self.sketches[name] = SKETCH_TYPES[sketch_type]([], **settings)
+        self.__record("init_"+sketch_type, [name]+list(settings.values()), self.sketches[name])
+
+    def sketch(self, name):
+        return self.sketches.get(name)
 
     def export(self):
         data = {
             "lists" : {},
-            "dicts" : {}
+            "dicts" : {},
+            "counters" : {},
+            "sketches" : {}
         }
         for dlist in self.dlists:
             data["lists"][dlist] = {
-                "data"      : self.dlists[dlist].data,
+                "data"      : self.dlists[dlist].export_data(),
                 "expire"    : self.dlists[dlist].expire
             }
+            if self.dlists[dlist].indexes:
+                data["lists"][dlist]["indexes"] = self.dlists[dlist].indexes
+            if self.dlists[dlist].storage != "list":
+                data["lists"][dlist]["storage"] = self.dlists[dlist].storage
 
         for ddict in self.ddicts:
             data["dicts"][ddict] = {
-                "data"      : self.ddicts[ddict].data,
+                "data"      : self.ddicts[ddict].export_data(),
                 "expire"    : self.ddicts[ddict].expire
             }
+            if self.ddicts[ddict].storage != "dict":
+                data["dicts"][ddict]["storage"] = self.ddicts[ddict].storage
+
+        for counter in self.counters:
+            data["counters"][counter] = {
+                "data"          : self.counters[counter].export_data(),
+                "expire"        : self.counters[counter].expire,
+                "bucket_size"   : self.counters[counter].bucket_size
+            }
+
+        for sketch in self.sketches:
+            data["sketches"][sketch] = {
+                "type"      : self.sketches[sketch].sketch_type,
+                "settings"  : self.sketches[sketch].settings(),
+                "data"      : self.sketches[sketch].export_data()
+            }
 
         return data
 
     def get(self, name):
-        if self.dlists.get(name):
+        if self.dlists.get(name) is not None:
             return self.dlists[name]
 
-        if self.ddicts.get(name):
+        if self.ddicts.get(name) is not None:
             return self.ddicts[name]
+
+        if self.counters.get(name) is not None:
+            return self.counters[name]
+
+        if self.sketches.get(name) is not None:
+            return self.sketches[name]
     
 
+def new_dlist(data, expire, indexes=None, storage="list"):
+    if storage == "compact":
+        return CompactDynamicList(data, expire)
+    if indexes:
+        return IndexedDynamicList(data, expire, indexes)
+    return DynamicList(data, expire)
+
+
 class DynamicDict:
     # DynamicDicts are less useful than DynamicLists for various reasons. Mainly, lists are more grainular to expire,
     # so in general it's best to store data in a dlist, then sort/organize it when checking things.
+
+    storage = "dict"
+    # (journal list, name) when changes are being recorded, see DynamicState.start_journal
+    journal = None
+    # Holds values of MUTABLE_TYPES
+    mutable = False
+
     def __init__(self, data = {}, expire = 3600):
         self.expire = expire
         self.data = data
@@ -85,12 +326,18 @@ class DynamicDict:
             if self.data[d]["created"] < old: continue
             newdata[d] = self.data[d]
             newsession[d] = self.data[d]["value"]
+            if type(newsession[d]) in MUTABLE_TYPES:
+                self.mutable = True
         self.data = newdata
         self.session_list = newsession
 
     def setitem(self, key, value, created=None):
         if created is None:
             created = int(time.time())
+        if self.journal is not None:
+            self.journal[0].append(["dict", self.journal[1], "setitem", [key, value, created]])
+        if type(value) in MUTABLE_TYPES:
+            self.mutable = True
         self.data[key] = {
                 "created"   : created,
                 "value"     : value
@@ -101,9 +348,570 @@ class DynamicDict:
     def get(self, key):
         return self.session_list.get(key)        
 
+    def export_data(self):
+        return self.data
+
+
+class SlidingCounter:
+    # Counts per key over the last expire seconds without keeping each event. Counts are added to
+    # fixed time buckets (oldest first), with a running total per key over all the buckets. A bucket
+    # is dropped once all of it is older than expire, so totals can include up to bucket_size
+    # seconds more than expire.
+
+    journal = None
+
+    # data is the list of [bucket start, [[key, count], ...]] saved by export_data()
+    def __init__(self, data = [], expire = 3600, bucket_size = 60):
+        self.expire = expire
+        self.bucket_size = bucket_size
+        self.buckets = deque()
+        self.totals = {}
+        for start, counts in data:
+            bucket = {}
+            for key, count in counts:
+                key = hashable(key)
+                bucket[key] = count
+                self.totals[key] = self.totals.get(key, 0) + count
+            self.buckets.append([start, bucket])
+        self.purge()
+
+    def purge(self):
+        old = int(time.time()) - self.expire
+        while len(self.buckets) > 0 and self.buckets[0][0] + self.bucket_size <= old:
+            for key, count in self.buckets.popleft()[1].items():
+                total = self.totals[key] - count
+                if total > 0:
+                    self.totals[key] = total
+                else:
+                    del(self.totals[key])
+
+    def __bucket(self, created):
+        start = created - created % self.bucket_size
+        if len(self.buckets) == 0 or self.buckets[-1][0] < start:
+            self.buckets.append([start, {}])
+            return self.buckets[-1][1]
+        # Older than the newest bucket, find or add its bucket
+        for i in range(len(self.buckets) - 1, -1, -1):
+            if self.buckets[i][0] == start:
+                return self.buckets[i][1]
+            if self.buckets[i][0] < start:
+                self.buckets.insert(i + 1, [start, {}])
+                return self.buckets[i + 1][1]
+        self.buckets.appendleft([start, {}])
+        return self.buckets[0][1]
+
+    def increment(self, key, amount=1, created=None):
+        if created is None:
+            created = int(time.time())
+        if self.journal is not None:
+            self.journal[0].append(["counter", self.journal[1], "increment", [key, amount, created]])
+        key = hashable(key)
+        bucket = self.__bucket(created)
+        bucket[key] = bucket.get(key, 0) + amount
+        self.totals[key] = self.totals.get(key, 0) + amount
+        if len(self.buckets) > 0 and self.buckets[0][0] + self.bucket_size <= int(time.time()) - self.expire:
+            self.purge()
+
+    # Count for key over the window, buckets that expired since the last purge are dropped first
+    def total(self, key):
+        self.purge()
+        return self.totals.get(hashable(key), 0)
+
+    def __len__(self):
+        self.purge()
+        return len(self.totals)
+
+    # Keys with a count of at least threshold, highest first, at most k of them when k is set
+    def top(self, k=None, threshold=0):
+        self.purge()
+        temp = sorted([t for t in self.totals.items() if t[1] >= threshold], key=lambda item: item[1])
+        temp.reverse()
+        if k is not None:
+            temp = temp[:k]
+        ordered = OrderedDict()
+        for t in temp:
+            ordered[t[0]] = t[1]
+        return ordered
+
+    # Same as DynamicList.counts, every key highest first
+    def counts(self):
+        return self.top()
+
+    def export_data(self):
+        return [[bucket[0], list(bucket[1].items())] for bucket in self.buckets]
+
+
+def hash64(value):
+    return int.from_bytes(hashlib.blake2b(json_value(value).encode(), digest_size=8).digest(), "little")
+
+def encode_array(values):
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return base64.b64encode(values.tobytes()).decode()
+
+def decode_array(typecode, data):
+    values = array(typecode)
+    values.frombytes(base64.b64decode(data))
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+class HyperLogLog:
+    # Estimates the number of distinct values added with 2^precision one byte registers. The
+    # relative error is about 1.04/sqrt(2^precision), two HyperLogLogs with the same precision
+    # can be merged. Registers start out sparse (a dict of the ones that aren't 0), which is much
+    # smaller for the few values most keys of a DistinctCounter see, and become a bytearray once
+    # more than 1/sparse_ratio of them are set.
+
+    sparse_ratio = 64
+
+    # registers: saved by export_data(), base64 of the bytearray or a list of [register, rank]
+    def __init__(self, precision, registers=None):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = None
+        self.sparse = None
+        if registers is None:
+            self.sparse = {}
+        elif type(registers) == list:
+            self.sparse = {}
+            for i, rank in registers:
+                self.sparse[i] = rank
+            self.__check_sparse()
+        else:
+            self.registers = bytearray(base64.b64decode(registers))
+
+    @staticmethod
+    def precision_for(error):
+        return min(16, max(4, int(math.ceil(math.log2((1.04 / error) ** 2)))))
+
+    def __check_sparse(self):
+        if len(self.sparse) <= self.m // self.sparse_ratio:
+            return
+        self.registers = bytearray(self.m)
+        for i in self.sparse:
+            self.registers[i] = self.sparse[i]
+        self.sparse = None
+
+    def add(self, value):
+        h = hash64(value)
+        bits = 64 - self.precision
+        i = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if self.sparse is not None:
+            if rank > self.sparse.get(i, 0):
+                self.sparse[i] = rank
+                self.__check_sparse()
+        elif rank > self.registers[i]:
+            self.registers[i] = rank
+
+    def merge(self, other):
+        if other.sparse is not None:
+            if self.sparse is not None:
+                for i in other.sparse:
+                    if other.sparse[i] > self.sparse.get(i, 0):
+                        self.sparse[i] = other.sparse[i]
+                self.__check_sparse()
+            else:
+                for i in other.sparse:
+                    if other.sparse[i] > self.registers[i]:
+                        self.registers[i] = other.sparse[i]
+            return
+        if self.sparse is not None:
+            registers = self.sparse
+            self.sparse = None
+            self.registers = bytearray(other.registers)
+            for i in registers:
+                if registers[i] > self.registers[i]:
+                    self.registers[i] = registers[i]
+            return
+        for i in range(self.m):
+            if other.registers[i] > self.registers[i]:
+                self.registers[i] = other.registers[i]
+
+    def count(self):
+        if self.m == 16:
+            alpha = 0.673
+        elif self.m == 32:
+            alpha = 0.697
+        elif self.m == 64:
+            alpha = 0.709
+        else:
+            alpha = 0.7213 / (1 + 1.079 / self.m)
+        if self.sparse is not None:
+            zeros = self.m - len(self.sparse)
+            total = zeros + sum(2.0 ** -r for r in self.sparse.values())
+        else:
+            zeros = self.registers.count(0)
+            total = sum(2.0 ** -r for r in self.registers)
+        estimate = alpha * self.m * self.m / total
+        if estimate <= 2.5 * self.m and zeros > 0:
+            # Small counts, linear counting is more accurate
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+    def export_data(self):
+        if self.sparse is not None:
+            return [[i, self.sparse[i]] for i in sorted(self.sparse)]
+        return base64.b64encode(bytes(self.registers)).decode()
+
+
+class CountMinSketch:
+    # Approximate counts per key in a fixed depth x width table of counters. Counts are never under,
+    # and are over by at most error * the total count with probability confidence. Two sketches with
+    # the same size can be merged.
+
+    def __init__(self, width, depth, table=None):
+        self.width = width
+        self.depth = depth
+        if table is None:
+            self.table = array("i", [0]) * (width * depth)
+        else:
+            self.table = decode_array("i", table)
+
+    @staticmethod
+    def size_for(error, confidence):
+        return int(math.ceil(math.e / error)), int(math.ceil(math.log(1 / (1 - confidence))))
+
+    def __cells(self, key):
+        digest = hashlib.blake2b(json_value(key).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    # Adds amount to key, returns the key's new estimate
+    def add(self, key, amount=1):
+        estimate = None
+        for cell in self.__cells(key):
+            self.table[cell] += amount
+            if estimate is None or self.table[cell] < estimate:
+                estimate = self.table[cell]
+        return estimate
+
+    def estimate(self, key):
+        return min(self.table[cell] for cell in self.__cells(key))
+
+    def merge(self, other):
+        for i in range(len(self.table)):
+            self.table[i] += other.table[i]
+
+    def export_data(self):
+        return encode_array(self.table)
+
+
+class WindowedSketch:
+    # Base for sketches over the last expire seconds. Sketches can't have values taken back out, so
+    # time is split into windows generations, each with its own sketches, and the oldest generation
+    # is dropped once all of it is older than expire. Like SlidingCounter, results can include up to
+    # expire/windows seconds more than expire.
+
+    journal = None
+
+    # data is the list of [generation start, generation data] saved by export_data()
+    def __init__(self, data, expire, windows):
+        self.expire = expire
+        self.windows = windows
+        self.length = max(1, int(math.ceil(expire / windows)))
+        self.generations = deque()
+        for start, saved in data:
+            self.generations.append([start, self.load_generation(saved)])
+        self.purge()
+
+    def purge(self):
+        old = int(time.time()) - self.expire
+        while len(self.generations) > 0 and self.generations[0][0] + self.length <= old:
+            self.generations.popleft()
+
+    def generation(self, created):
+        start = created - created % self.length
+        if start + self.length <= int(time.time()) - self.expire:
+            # Already expired, counted in a generation that isn't kept
+            return self.new_generation()
+        if len(self.generations) == 0 or self.generations[-1][0] < start:
+            self.generations.append([start, self.new_generation()])
+            self.purge()
+            return self.generations[-1][1]
+        for i in range(len(self.generations) - 1, -1, -1):
+            if self.generations[i][0] == start:
+                return self.generations[i][1]
+            if self.generations[i][0] < start:
+                self.generations.insert(i + 1, [start, self.new_generation()])
+                return self.generations[i + 1][1]
+        self.generations.appendleft([start, self.new_generation()])
+        return self.generations[0][1]
+
+    # Add another sketch's counts into this one, e.g. the same sketch from another monitor process
+    def merge(self, other):
+        if self.sketch_type != other.sketch_type or self.settings() != other.settings():
+            raise ValueError("Only sketches with the same type and settings can be merged")
+        for start, saved in other.generations:
+            self.merge_generation(self.generation(start), saved)
+        self.purge()
+
+    def export_data(self):
+        return [[g[0], self.export_generation(g[1])] for g in self.generations]
+
+
+class DistinctCounter(WindowedSketch):
+    # Number of distinct values seen per key (e.g. usernames tried per ip), a HyperLogLog per key per
+    # generation. Use key None for a single count. Keys with few values only keep a few registers
+    # (see HyperLogLog sparse registers).
+
+    sketch_type = "distinct"
+
+    def __init__(self, data = [], expire = 3600, error = 0.02, windows = 4):
+        self.error = error
+        self.precision = HyperLogLog.precision_for(error)
+        WindowedSketch.__init__(self, data, expire, windows)
+
+    def settings(self):
+        return {"expire": self.expire, "error": self.error, "windows": self.windows}
+
+    def new_generation(self):
+        return {}
+
+    def load_generation(self, saved):
+        generation = {}
+        for key, registers in saved:
+            generation[hashable(key)] = HyperLogLog(self.precision, registers)
+        return generation
+
+    def export_generation(self, generation):
+        return [[key, generation[key].export_data()] for key in generation]
+
+    def merge_generation(self, generation, other):
+        for key in other:
+            if generation.get(key) is None:
+                generation[key] = HyperLogLog(self.precision)
+            generation[key].merge(other[key])
+
+    def add(self, key, value, created=None):
+        if created is None:
+            created = int(time.time())
+        if self.journal is not None:
+            self.journal[0].append(["sketch", self.journal[1], "add", [key, value, created]])
+        key = hashable(key)
+        generation = self.generation(created)
+        if generation.get(key) is None:
+            generation[key] = HyperLogLog(self.precision)
+        generation[key].add(value)
+
+    def count(self, key=None):
+        key = hashable(key)
+        total = None
+        for g in self.generations:
+            if g[1].get(key) is None:
+                continue
+            if total is None:
+                total = HyperLogLog(self.precision)
+            total.merge(g[1][key])
+        if total is None:
+            return 0
+        return total.count()
+
+    def keys(self):
+        keys = set()
+        for g in self.generations:
+            keys.update(g[1].keys())
+        return list(keys)
+
+    # Keys with at least threshold distinct values, highest first
+    def counts(self, threshold=0):
+        temp = [(key, self.count(key)) for key in self.keys()]
+        temp = sorted([t for t in temp if t[1] >= threshold], key=lambda item: item[1])
+        temp.reverse()
+        ordered = OrderedDict()
+        for t in temp:
+            ordered[t[0]] = t[1]
+        return ordered
+
+
+class FrequencySketch(WindowedSketch):
+    # Approximate count per key and the heavy hitters (most frequent keys), a CountMinSketch per
+    # generation plus the heavy_hitters keys with the highest counts in it.
+
+    sketch_type = "frequency"
+
+    def __init__(self, data = [], expire = 3600, error = 0.005, confidence = 0.99, heavy_hitters = 100, windows = 4):
+        self.error = error
+        self.confidence = confidence
+        self.heavy_hitters = heavy_hitters
+        self.width, self.depth = CountMinSketch.size_for(error, confidence)
+        WindowedSketch.__init__(self, data, expire, windows)
+
+    def settings(self):
+        return {"expire": self.expire, "error": self.error, "confidence": self.confidence,
+            "heavy_hitters": self.heavy_hitters, "windows": self.windows}
+
+    def new_generation(self):
+        return {"cms": CountMinSketch(self.width, self.depth), "hitters": {}}
+
+    def load_generation(self, saved):
+        hitters = {}
+        for key, count in saved["hitters"]:
+            hitters[hashable(key)] = count
+        return {"cms": CountMinSketch(self.width, self.depth, saved["cms"]), "hitters": hitters}
+
+    def export_generation(self, generation):
+        return {"cms": generation["cms"].export_data(), "hitters": list(generation["hitters"].items())}
+
+    def merge_generation(self, generation, other):
+        generation["cms"].merge(other["cms"])
+        for key in set(generation["hitters"]) | set(other["hitters"]):
+            generation["hitters"][key] = generation["cms"].estimate(key)
+        self.__trim(generation["hitters"])
+
+    # Keep the heavy hitter candidates at about heavy_hitters, trimmed once they double
+    def __trim(self, hitters, force=True):
+        if len(hitters) <= self.heavy_hitters or (force == False and len(hitters) < self.heavy_hitters * 2):
+            return
+        keep = sorted(hitters.items(), key=lambda item: item[1], reverse=True)[:self.heavy_hitters]
+        hitters.clear()
+        hitters.update(keep)
+
+    def add(self, key, amount=1, created=None):
+        if created is None:
+            created = int(time.time())
+        if self.journal is not None:
+            self.journal[0].append(["sketch", self.journal[1], "add", [key, amount, created]])
+        key = hashable(key)
+        generation = self.generation(created)
+        generation["hitters"][key] = generation["cms"].add(key, amount)
+        self.__trim(generation["hitters"], False)
+
+    def estimate(self, key):
+        key = hashable(key)
+        return sum(g[1]["cms"].estimate(key) for g in self.generations)
+
+    # The most frequent keys over the window with at least threshold, highest first
+    def top(self, k=None, threshold=0):
+        keys = set()
+        for g in self.generations:
+            keys.update(g[1]["hitters"].keys())
+        temp = sorted([t for t in [(key, self.estimate(key)) for key in keys] if t[1] >= threshold], key=lambda item: item[1])
+        temp.reverse()
+        if k is None:
+            k = self.heavy_hitters
+        ordered = OrderedDict()
+        for t in temp[:k]:
+            ordered[t[0]] = t[1]
+        return ordered
+
+
+def bloom_positions(key, size, hashes):
+    digest = hashlib.blake2b(json_value(key).encode(), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:], "little") | 1
+    return [(h1 + i * h2) % size for i in range(hashes)]
+
+
+class BloomFilter:
+    # Bit array with hashes bits set per key. A key that was added is always found, one that wasn't
+    # is found with probability error_rate as long as no more than capacity keys are added.
+
+    def __init__(self, size, hashes, bits=None):
+        self.size = size
+        self.hashes = hashes
+        if bits is None:
+            self.bits = bytearray((size + 7) // 8)
+        else:
+            self.bits = bytearray(base64.b64decode(bits))
+
+    @staticmethod
+    def size_for(capacity, error_rate):
+        size = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        return size, max(1, int(round(size / capacity * math.log(2))))
+
+    def positions(self, key):
+        return bloom_positions(key, self.size, self.hashes)
+
+    def add(self, positions):
+        for p in positions:
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def contains(self, positions):
+        for p in positions:
+            if self.bits[p >> 3] & (1 << (p & 7)) == 0:
+                return False
+        return True
+
+    def merge(self, other):
+        for i in range(len(self.bits)):
+            self.bits[i] |= other.bits[i]
+
+    def export_data(self):
+        return base64.b64encode(bytes(self.bits)).decode()
+
+
+class SeenFilter(WindowedSketch):
+    # Keys seen in the last ttl (expire) seconds, a Bloom filter per generation, for "already alerted on
+    # this" checks without keeping the keys. Up to windows + 1 generations are checked, so each one is
+    # sized for capacity/windows keys and error_rate/(windows + 1) to keep false "seen"s at about error_rate.
+    # Keys are forgotten between ttl and ttl + ttl/windows seconds after they were last added.
+
+    sketch_type = "seen"
+
+    def __init__(self, data = [], expire = 86400, capacity = 100000, error_rate = 0.001, windows = 4):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size, self.hashes = BloomFilter.size_for(max(1, capacity // windows), error_rate / (windows + 1))
+        WindowedSketch.__init__(self, data, expire, windows)
+
+    def settings(self):
+        return {"expire": self.expire, "capacity": self.capacity, "error_rate": self.error_rate, "windows": self.windows}
+
+    def new_generation(self):
+        return BloomFilter(self.size, self.hashes)
+
+    def load_generation(self, saved):
+        return BloomFilter(self.size, self.hashes, saved)
+
+    def export_generation(self, generation):
+        return generation.export_data()
+
+    def merge_generation(self, generation, other):
+        generation.merge(other)
+
+    # Returns True if key was already seen, so add() can check and add in one go
+    def add(self, key, created=None):
+        if created is None:
+            created = int(time.time())
+        if self.journal is not None:
+            self.journal[0].append(["sketch", self.journal[1], "add", [key, created]])
+        positions = bloom_positions(key, self.size, self.hashes)
+        seen = self.__contains(positions)
+        self.generation(created).add(positions)
+        return seen
+
+    def __contains(self, positions):
+        for g in self.generations:
+            if g[1].contains(positions):
+                return True
+        return False
+
+    def contains(self, key):
+        return self.__contains(bloom_positions(key, self.size, self.hashes))
+
+    def __contains__(self, key):
+        return self.contains(key)
+
+
+SKETCH_TYPES = {
+    "distinct"  : DistinctCounter,
+    "frequency" : FrequencySketch,
+    "seen"      : SeenFilter
+}
+
 
 class DynamicList:
 
+    storage = "list"
+    indexes = None
+    journal = None
+    mutable = False
+
     def __init__(self, data = [], expire = 3600):
         self.expire = expire
         self.data = data
@@ -119,15 +927,24 @@ class DynamicList:
             if d["created"] < old: continue
             newdata.append(d)
             newsession.append(d["value"])
+            if type(d["value"]) in MUTABLE_TYPES:
+                self.mutable = True
         self.data = newdata
         self.session_list = newsession
 
     def items(self):
         return self.session_list
 
+    def export_data(self):
+        return self.data
+
     def append(self, value, created=None):
         if created is None:
             created = int(time.time())
+        if self.journal is not None:
+            self.journal[0].append(["list", self.journal[1], "append", [value, created]])
+        if type(value) in MUTABLE_TYPES:
+            self.mutable = True
         self.data.append(
             {
                 "created"   : created,
@@ -136,8 +953,11 @@ class DynamicList:
         )
         self.session_list.append(value)
 
-    def touch(self, value):
-        created = int(time.time())
+    def touch(self, value, created=None):
+        if created is None:
+            created = int(time.time())
+        if self.journal is not None:
+            self.journal[0].append(["list", self.journal[1], "touch", [value, created]])
         for d in self.data:
             if d["value"] == value:
                 d["created"] = created
@@ -186,4 +1006,643 @@ class DynamicList:
                 match = False
             if match:
                 items.append(d)
-        return items
\ No newline at end of file
+        return items
+
+
+class IndexedDynamicList:
+    # Same interface as DynamicList. Entries are kept oldest first in a deque so expired ones are popped
+    # off the front, and the keys in indexes get a hash index (value -> entries) with live counts.
+    # Entries are [created, value, alive, index keys], touch() marks the entry dead and appends it again
+    # as new. The index keys are the (key, value) pairs the entry was indexed under when it was added, a
+    # monitor changing an indexed field afterwards doesn't move the entry in the index.
+    # Entries appended with an older created time than the newest one expire once the ones in front
+    # of them have.
+
+    storage = "list"
+    journal = None
+    mutable = False
+
+    def __init__(self, data = [], expire = 3600, indexes = []):
+        self.expire = expire
+        self.indexes = list(indexes)
+        self.entries = deque()
+        self.index = {}
+        self.index_counts = {}
+        for key in self.indexes:
+            self.index[key] = {}
+            self.index_counts[key] = {}
+        self.dead = 0
+        for d in sorted(data, key=lambda d: d["created"]):
+            self.__add(d["created"], d["value"])
+        self.purge()
+
+    def __add(self, created, value):
+        entry = [created, value, True, []]
+        self.entries.append(entry)
+        if type(value) in MUTABLE_TYPES:
+            self.mutable = True
+        for key in self.indexes:
+            try:
+                v = value[key]
+                bucket = self.index[key].get(v)
+            except (KeyError, TypeError):
+                # Not a dict, no such key or an unhashable value, the entry isn't indexed on this key
+                continue
+            if bucket is None:
+                bucket = self.index[key][v] = deque()
+                self.index_counts[key][v] = 0
+            bucket.append(entry)
+            self.index_counts[key][v] += 1
+            entry[3].append((key, v))
+
+    def __kill(self, entry):
+        entry[2] = False
+        self.dead += 1
+        for key, v in entry[3]:
+            self.index_counts[key][v] -= 1
+
+    def purge(self):
+        old = int(time.time()) - self.expire
+        entries = self.entries
+        while len(entries) > 0 and entries[0][0] < old:
+            entry = entries.popleft()
+            if entry[2]:
+                self.__kill(entry)
+            self.dead -= 1
+            # Buckets are in the same order as entries, so this entry is at the front of its buckets
+            for key, v in entry[3]:
+                bucket = self.index[key][v]
+                bucket.popleft()
+                if len(bucket) == 0:
+                    del(self.index[key][v])
+                    del(self.index_counts[key][v])
+
+        # Drop touched (dead) entries once they make up most of the list
+        if self.dead > 1000 and self.dead > len(entries) / 2:
+            live = [e for e in entries if e[2]]
+            self.__init__([{"created": e[0], "value": e[1]} for e in live], self.expire, self.indexes)
+
+    @property
+    def data(self):
+        return [{"created": e[0], "value": e[1]} for e in self.entries if e[2]]
+
+    def export_data(self):
+        return self.data
+
+    def items(self):
+        return [e[1] for e in self.entries if e[2]]
+
+    def append(self, value, created=None):
+        if created is None:
+            created = int(time.time())
+        if self.journal is not None:
+            self.journal[0].append(["list", self.journal[1], "append", [value, created]])
+        self.__add(created, value)
+        if self.entries[0][0] < created - self.expire:
+            self.purge()
+
+    def touch(self, value, created=None):
+        if created is None:
+            created = int(time.time())
+        if self.journal is not None:
+            self.journal[0].append(["list", self.journal[1], "touch", [value, created]])
+        for entry in self.__candidates(value):
+            if entry[2] and entry[1] == value:
+                self.__kill(entry)
+                self.__add(created, entry[1])
+                return True
+        return False
+
+    # Entries that could match value, from the first index it has a key for
+    def __candidates(self, value):
+        for key in self.indexes:
+            try:
+                return list(self.index[key].get(value[key], []))
+            except (KeyError, TypeError):
+                continue
+        return list(self.entries)
+
+    def counts(self, item_key):
+        if item_key not in self.index_counts:
+            item_counts = {}
+            for d in self.items():
+                if item_counts.get(d[item_key]) is None:
+                    item_counts[d[item_key]] = 0
+                item_counts[d[item_key]] += 1
+        else:
+            item_counts = self.index_counts[item_key]
+
+        temp = sorted([i for i in item_counts.items() if i[1] > 0], key=lambda item: item[1])
+        temp.reverse()
+        ordered = OrderedDict()
+        for t in temp:
+            ordered[t[0]] = t[1]
+        return ordered
+
+    def unique(self, key):
+        if key in self.index_counts:
+            return [v for v in self.index_counts[key] if self.index_counts[key][v] > 0]
+        items = set()
+        for d in self.items():
+            items.add(d[key])
+        return list(items)
+
+    def filter(self, key, value):
+        if key in self.index:
+            try:
+                return [e[1] for e in self.index[key].get(value, []) if e[2]]
+            except TypeError:
+                pass
+        items = list()
+        for d in self.items():
+            if d[key] == value:
+                items.append(d)
+        return items
+
+    def adv_filter(self, filters):
+        candidates = None
+        for f in filters:
+            if f[0] in self.index:
+                candidates = self.filter(f[0], f[1])
+                break
+        if candidates is None:
+            candidates = self.items()
+        items = list()
+        for d in candidates:
+            match = True
+            for f in filters:
+                if d[f[0]] == f[1]:
+                    continue
+                match = False
+            if match:
+                items.append(d)
+        return items
+
+
+class CompactDynamicList:
+    # Same interface as DynamicList, for lists too big to keep as a dict per entry. Created times are
+    # kept in an array, values are stored by column: for each key an array of ids into a table of
+    # the distinct values seen for that key (-1 when an entry doesn't have the key). Values are
+    # rebuilt as dicts when they are asked for. Non dict values are stored under the key None.
+    # The rebuilt dicts are copies, so they are read-only (ReadOnlyItem), change an entry by
+    # appending it again. Values are interned by type and value, True, 1 and 1.0 are kept apart.
+
+    storage = "compact"
+    indexes = None
+    journal = None
+    # Unhashable field values are handed out as they are stored, not copied
+    mutable = False
+
+    # data is a list of {"created", "value"} or the columns saved by export_data()
+    def __init__(self, data = [], expire = 3600):
+        self.expire = expire
+        self.created = array("l")
+        self.columns = {}
+        self.tables = {}
+        self.table_ids = {}
+        if type(data) == dict:
+            self.created = array("l", data["created"])
+            for field, column in data["columns"]:
+                self.columns[field] = array("l", column)
+            for field, table in data["tables"]:
+                self.tables[field] = table
+                self.table_ids[field] = {}
+                for i in range(len(table)):
+                    try:
+                        self.table_ids[field][(type(table[i]), table[i])] = i
+                    except TypeError:
+                        self.mutable = True
+        else:
+            for d in data:
+                self.append(d["value"], d["created"])
+        self.purge()
+
+    def __intern(self, field, value):
+        try:
+            key = (type(value), value)
+            value_id = self.table_ids[field].get(key)
+            if value_id is None:
+                value_id = self.table_ids[field][key] = len(self.tables[field])
+                self.tables[field].append(value)
+            return value_id
+        except TypeError:
+            # Unhashable values (lists, dicts) are stored once per entry
+            self.mutable = True
+            self.tables[field].append(value)
+            return len(self.tables[field]) - 1
+
+    def __value(self, i):
+        value = {}
+        for field in self.columns:
+            value_id = self.columns[field][i]
+            if value_id == -1:
+                continue
+            if field is None:
+                return self.tables[None][value_id]
+            value[field] = self.tables[field][value_id]
+        return ReadOnlyItem(value)
+
+    # Ids of the values that compare equal to value, like a DynamicList filter (1 == 1.0 == True)
+    def __value_ids(self, key, value):
+        value_types = [type(value)]
+        if type(value) in (bool, int, float):
+            value_types = [bool, int, float]
+        value_ids = set()
+        for value_type in value_types:
+            value_id = self.table_ids[key].get((value_type, value))
+            if value_id is not None:
+                value_ids.add(value_id)
+        return value_ids
+
+    def __column(self, key):
+        column = self.columns.get(key)
+        if column is None or -1 in column:
+            raise KeyError(key)
+        return column
+
+    def __len__(self):
+        return len(self.created)
+
+    def append(self, value, created=None):
+        if created is None:
+            created = int(time.time())
+        if self.journal is not None:
+            self.journal[0].append(["list", self.journal[1], "append", [value, created]])
+        n = len(self.created)
+        self.created.append(created)
+        if type(value) == dict:
+            fields = value.items()
+        else:
+            fields = [(None, value)]
+        for field, v in fields:
+            column = self.columns.get(field)
+            if column is None:
+                column = self.columns[field] = array("l", [-1]) * n
+                self.tables[field] = []
+                self.table_ids[field] = {}
+            column.append(self.__intern(field, v))
+        for field in self.columns:
+            if len(self.columns[field]) == n:
+                self.columns[field].append(-1)
+
+    def purge(self):
+        old = int(time.time()) - self.expire
+        keep = [i for i in range(len(self.created)) if self.created[i] >= old]
+        if len(keep) == len(self.created):
+            return
+
+        # Rebuild the columns and tables with only the values still in use
+        columns = self.columns
+        tables = self.tables
+        self.created = array("l", [self.created[i] for i in keep])
+        self.columns = {}
+        self.tables = {}
+        self.table_ids = {}
+        for field in columns:
+            column = columns[field]
+            if all(column[i] == -1 for i in keep):
+                continue
+            self.tables[field] = []
+            self.table_ids[field] = {}
+            new_column = array("l")
+            for i in keep:
+                if column[i] == -1:
+                    new_column.append(-1)
+                else:
+                    new_column.append(self.__intern(field, tables[field][column[i]]))
+            self.columns[field] = new_column
+
+    @property
+    def data(self):
+        return [{"created": self.created[i], "value": self.__value(i)} for i in range(len(self.created))]
+
+    def export_data(self):
+        return {
+            "created"   : self.created.tolist(),
+            "columns"   : [[field, self.columns[field].tolist()] for field in self.columns],
+            "tables"    : [[field, self.tables[field]] for field in self.tables]
+        }
+
+    def items(self):
+        return [self.__value(i) for i in range(len(self.created))]
+
+    def touch(self, value, created=None):
+        if created is None:
+            created = int(time.time())
+        if self.journal is not None:
+            self.journal[0].append(["list", self.journal[1], "touch", [value, created]])
+        for i in range(len(self.created)):
+            if self.__value(i) == value:
+                self.created[i] = created
+                return True
+        return False
+
+    def counts(self, item_key):
+        column = self.__column(item_key)
+        id_counts = {}
+        for value_id in column:
+            if id_counts.get(value_id) is None:
+                id_counts[value_id] = 0
+            id_counts[value_id] += 1
+
+        item_counts = {}
+        table = self.tables[item_key]
+        for value_id in id_counts:
+            value = table[value_id]
+            if item_counts.get(value) is None:
+                item_counts[value] = 0
+            item_counts[value] += id_counts[value_id]
+
+        temp = sorted(item_counts.items(), key=lambda item: item[1])
+        temp.reverse()
+        ordered = OrderedDict()
+        for t in temp:
+            ordered[t[0]] = t[1]
+        return ordered
+
+    def unique(self, key):
+        column = self.__column(key)
+        table = self.tables[key]
+        items = set()
+        for value_id in set(column):
+            items.add(table[value_id])
+        return list(items)
+
+    def filter(self, key, value):
+        column = self.__column(key)
+        try:
+            value_ids = self.__value_ids(key, value)
+        except TypeError:
+            return [d for d in self.items() if d[key] == value]
+        if len(value_ids) == 0:
+            return []
+        return [self.__value(i) for i in range(len(column)) if column[i] in value_ids]
+
+    def adv_filter(self, filters):
+        if len(filters) == 0:
+            return self.items()
+        items = list()
+        for d in self.filter(filters[0][0], filters[0][1]):
+            match = True
+            for f in filters:
+                if d[f[0]] == f[1]:
+                    continue
+                match = False
+            if match:
+                items.append(d)
+        return items
+
+
+class ReadOnlyItem(dict):
+    # Entries of a CompactDynamicList, rebuilt from its columns. Changing one wouldn't change the list,
+    # so it raises instead of losing the change silently.
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError("Items of a compact dlist are copies and can't be changed, append the changed value instead")
+
+    __setitem__ = __readonly
+    __delitem__ = __readonly
+    clear = __readonly
+    pop = __readonly
+    popitem = __readonly
+    setdefault = __readonly
+    update = __readonly
+    __ior__ = __readonly
+
+    # Copied and pickled as a plain dict, which can be changed
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class SQLiteDynamicList:
+    # Same interface as DynamicList, for lists too big to load into memory. Entries are rows in the
+    # monitor's sqlite db (table "dlist_<name>"), values are stored as json. filter/counts/unique are
+    # queries with json_extract, the keys in indexes get an index on that expression. Expiring is a
+    # DELETE on the indexed created column. The rows are saved when the monitor's sqlstate is
+    # committed, so they are left out of the state file and the journal.
+
+    storage = "sqlite"
+    journal = None
+    # Values are copied in and out of sqlite
+    mutable = False
+
+    # Rows fetched at a time when going through the whole list
+    page_size = 1000
+
+    # data: entries to add when the table is new, so a list switched to sqlite keeps its data
+    def __init__(self, sqlstate, name, data = [], expire = 3600, indexes = []):
+        self.sqlstate = sqlstate
+        self.name = name
+        self.expire = expire
+        self.indexes = list(indexes) if indexes else None
+        self.table = quote_name(sqlstate.table("dlist_"+name))
+        self.ready = False
+        self.pending = data
+
+    # Tables are created the first time the list is used, so an unused list never opens the db
+    def __cur(self):
+        db = self.sqlstate.connect()
+        if self.ready:
+            return db.cursor()
+        cur = db.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS "+self.table+" (id INTEGER PRIMARY KEY, created integer, value text)")
+        cur.execute("CREATE INDEX IF NOT EXISTS "+quote_name(self.sqlstate.table("dlist_"+self.name+"_created"))+" ON "+self.table+" (created)")
+        for key in self.indexes or []:
+            cur.execute("CREATE INDEX IF NOT EXISTS "+quote_name(self.sqlstate.table("dlist_"+self.name+"_"+key))+" ON "+self.table+" ("+json_field(key)+")")
+        self.ready = True
+
+        if self.pending:
+            cur.execute("SELECT count(*) FROM "+self.table)
+            if cur.fetchone()[0] == 0:
+                cur.executemany("INSERT INTO "+self.table+" (created, value) VALUES (?,?)",
+                    [(d["created"], json_value(d["value"])) for d in self.pending])
+        self.pending = None
+        self.purge()
+        return cur
+
+    def __len__(self):
+        cur = self.__cur()
+        cur.execute("SELECT count(*) FROM "+self.table)
+        return cur.fetchone()[0]
+
+    def purge(self):
+        if self.ready == False:
+            # Purged when the table is set up
+            self.__cur()
+            return
+        cur = self.sqlstate.connect().cursor()
+        cur.execute("DELETE FROM "+self.table+" WHERE created < ?", (int(time.time()) - self.expire,))
+
+    def drop(self):
+        cur = self.sqlstate.connect().cursor()
+        cur.execute("DROP TABLE IF EXISTS "+self.table)
+        self.ready = False
+
+    # Pages through the rows instead of loading them all at once
+    def __rows(self, where="", params=()):
+        cur = self.__cur()
+        last_id = 0
+        while True:
+            cur.execute("SELECT id, created, value FROM "+self.table+" WHERE id > ?"+where+" ORDER BY id LIMIT ?",
+                (last_id,)+tuple(params)+(self.page_size,))
+            rows = cur.fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < self.page_size:
+                break
+            last_id = rows[-1][0]
+
+    def __iter__(self):
+        for row in self.__rows():
+            yield json.loads(row[2])
+
+    @property
+    def data(self):
+        return [{"created": row[1], "value": json.loads(row[2])} for row in self.__rows()]
+
+    def export_data(self):
+        return []
+
+    def items(self):
+        return list(self)
+
+    def append(self, value, created=None):
+        if created is None:
+            created = int(time.time())
+        self.__cur().execute("INSERT INTO "+self.table+" (created, value) VALUES (?,?)", (created, json_value(value)))
+
+    def touch(self, value, created=None):
+        if created is None:
+            created = int(time.time())
+        cur = self.__cur()
+        cur.execute("UPDATE "+self.table+" SET created = ? WHERE id = (SELECT id FROM "+self.table+" WHERE value = ? LIMIT 1)",
+            (created, json_value(value)))
+        return cur.rowcount > 0
+
+    def counts(self, item_key):
+        cur = self.__cur()
+        field = json_field(item_key)
+        cur.execute("SELECT "+field+", count(*) AS c FROM "+self.table+" WHERE "+field+" IS NOT NULL GROUP BY "+field+" ORDER BY c DESC")
+        ordered = OrderedDict()
+        for row in cur.fetchall():
+            ordered[row[0]] = row[1]
+        return ordered
+
+    def unique(self, key):
+        cur = self.__cur()
+        field = json_field(key)
+        cur.execute("SELECT DISTINCT "+field+" FROM "+self.table+" WHERE "+field+" IS NOT NULL")
+        return [row[0] for row in cur.fetchall()]
+
+    def filter(self, key, value):
+        return self.adv_filter([(key, value)])
+
+    def adv_filter(self, filters):
+        where = ""
+        params = []
+        for f in filters:
+            if type(f[1]) in (dict, list, tuple):
+                # json_extract returns objects and arrays as compact json text, compare that
+                where += " AND json_type(value, "+json_path(f[0])+") IN ('object', 'array') AND "+json_field(f[0])+" = ?"
+                params.append(json.dumps(f[1], sort_keys=True, separators=(",", ":")))
+            elif type(f[1]) == str:
+                # Same text as an object or array isn't the same value
+                where += " AND "+json_field(f[0])+" = ? AND json_type(value, "+json_path(f[0])+") = 'text'"
+                params.append(f[1])
+            else:
+                where += " AND "+json_field(f[0])+" = ?"
+                params.append(f[1])
+        return [json.loads(row[2]) for row in self.__rows(where, params)]
+
+
+class SQLiteDynamicDict:
+    # Same interface as DynamicDict, kept in the monitor's sqlite db (table "ddict_<name>")
+
+    storage = "sqlite"
+    journal = None
+    # Values are copied in and out of sqlite
+    mutable = False
+
+    def __init__(self, sqlstate, name, data = {}, expire = 3600):
+        self.sqlstate = sqlstate
+        self.name = name
+        self.expire = expire
+        self.table = quote_name(sqlstate.table("ddict_"+name))
+        self.ready = False
+        self.pending = data
+
+    def __cur(self):
+        db = self.sqlstate.connect()
+        if self.ready:
+            return db.cursor()
+        cur = db.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS "+self.table+" (key PRIMARY KEY, created integer, value text)")
+        cur.execute("CREATE INDEX IF NOT EXISTS "+quote_name(self.sqlstate.table("ddict_"+self.name+"_created"))+" ON "+self.table+" (created)")
+        self.ready = True
+
+        if self.pending:
+            cur.execute("SELECT count(*) FROM "+self.table)
+            if cur.fetchone()[0] == 0:
+                cur.executemany("INSERT INTO "+self.table+" VALUES (?,?,?)",
+                    [(key, self.pending[key]["created"], json_value(self.pending[key]["value"])) for key in self.pending])
+        self.pending = None
+        self.purge()
+        return cur
+
+    def purge(self):
+        if self.ready == False:
+            self.__cur()
+            return
+        cur = self.sqlstate.connect().cursor()
+        cur.execute("DELETE FROM "+self.table+" WHERE created < ?", (int(time.time()) - self.expire,))
+
+    def drop(self):
+        cur = self.sqlstate.connect().cursor()
+        cur.execute("DROP TABLE IF EXISTS "+self.table)
+        self.ready = False
+
+    @property
+    def data(self):
+        cur = self.__cur()
+        cur.execute("SELECT key, created, value FROM "+self.table)
+        data = {}
+        for row in cur.fetchall():
+            data[row[0]] = {"created": row[1], "value": json.loads(row[2])}
+        return data
+
+    def export_data(self):
+        return {}
+
+    def setitem(self, key, value, created=None):
+        if created is None:
+            created = int(time.time())
+        self.__cur().execute("INSERT OR REPLACE INTO "+self.table+" VALUES (?,?,?)", (key, created, json_value(value)))
+
+    def get(self, key):
+        cur = self.__cur()
+        cur.execute("SELECT value FROM "+self.table+" WHERE key = ?", (key,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+
+# Tuple keys come back from json as lists
+def hashable(key):
+    if type(key) == list:
+        return tuple(hashable(k) for k in key)
+    return key
+
+def quote_name(name):
+    return '"'+name.replace('"', '""')+'"'
+
+# Keys are sorted so equal dicts are stored as the same text (touch compares the json)
+def json_value(value):
+    return json.dumps(value, sort_keys=True)
+
+# The sql for a key of the stored values, written out (not a parameter) so it matches the expression indexes
+def json_field(key):
+    return "json_extract(value, "+json_path(key)+")"
+
+def json_path(key):
+    return "'$.\""+str(key).replace('"', '').replace("'", "''")+"\"'"
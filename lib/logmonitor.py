@@ -9,11 +9,26 @@ from email.mime.text import MIMEText
 import email
 sys.path.append(os.path.join(os.path.dirname(__file__), "../"))
 import dynamicstate
+import logreader
 import config
 import output as out
+import statefile
 import glob
 import importlib
 import sqlite3
+import re
+
+# Save dstate changes to an append-only journal instead of rewriting the whole state file every scan,
+# the journal is compacted into the state file once it's bigger than STATE_JOURNAL_COMPACT_SIZE
+try:
+    STATE_JOURNAL = config.STATE_JOURNAL
+except AttributeError:
+    STATE_JOURNAL = False
+
+try:
+    STATE_JOURNAL_COMPACT_SIZE = config.STATE_JOURNAL_COMPACT_SIZE
+except AttributeError:
+    STATE_JOURNAL_COMPACT_SIZE = 64*1024*1024
 
 class Logmonitor:
 
@@ -24,6 +39,10 @@ class Logmonitor:
     max_emails = 100
     max_email_length = 1048576
 
+    # Keep the sqlstate tables in the shared db when SQLSTATE_SHARED is on. Only for monitors whose
+    # queries name their tables with self.sqlstate.table(name), the tables are <monitor>__<table> there.
+    sqlstate_shared = False
+
     current_timestamp = int(time.time())
     
     def __init__(self):
@@ -57,11 +76,47 @@ class Logmonitor:
 
         self.state = {}
         self.dstate = None
-        self.sqlstate = SQLState(os.path.join(self.state_root_path,self.__class__.__name__+".sqlite"))
+        self.journal_seq = 0
+        if SQLSTATE_SHARED and self.sqlstate_shared:
+            self.sqlstate = SQLState(SQLSTATE_SHARED_PATH, self.__class__.__name__+"__", True,
+                os.path.join(self.state_root_path,self.__class__.__name__+".sqlite"))
+        else:
+            self.sqlstate = SQLState(os.path.join(self.state_root_path,self.__class__.__name__+".sqlite"))
         self.queued_emails = list()
         self.__load_state()
         self.check_count = 0
-        
+
+    # Only called when the monitor is kept loaded between scans (persistent daemon), resets
+    # everything that a freshly loaded monitor would start the scan with. Attributes the monitor
+    # sets itself (in __init__ or init_cfg) are kept, reset per scan ones in init_scan.
+    def begin_scan(self):
+        self.errors = []
+        self.check_count = 0
+        self.queued_emails = list()
+        self.current_timestamp = int(time.time())
+        self.dstate.purge()
+        # init_table isn't called again, it normally expires the old rows
+        self.sqlstate.purge_tables()
+        self.__requeue_emails()
+        self.__init_scan()
+
+    # Monitors can define init_scan() to set up anything that should start empty every scan, it's
+    # called after init_cfg and before each scan of a persistent daemon
+    def __init_scan(self):
+        if self.enabled == False:
+            return
+        try:
+            init_scan = self.init_scan
+        except AttributeError:
+            return
+        try:
+            init_scan()
+        except BaseException as e:
+            if self.debug_modules:
+                raise e
+            self.print_error(e)
+            self.enabled = False
+
     # Decorator to be used to keep track of how long functions take
     def __trackruntime(totaltime):
         def inner(func):
@@ -84,8 +139,7 @@ class Logmonitor:
         state_path = os.path.join(self.state_root_path,self.__class__.__name__)
 
         try:
-            with open(state_path) as f:
-                self.state = json.load(f)
+            self.state = statefile.load(state_path)
         except FileNotFoundError:
             self.state = {
                 "monitor_name" : self.__class__.__name__,
@@ -94,14 +148,70 @@ class Logmonitor:
             }
 
         if self.state.get("_dynamic_state") is None:
-            self.dstate = dynamicstate.DynamicState({})
+            self.dstate = dynamicstate.DynamicState({}, self.sqlstate)
 
         else:
-            self.dstate = dynamicstate.DynamicState(self.state["_dynamic_state"])
+            self.dstate = dynamicstate.DynamicState(self.state["_dynamic_state"], self.sqlstate)
             # Don't save this twice in memory, it can be fairly large
             del(self.state["_dynamic_state"])
 
+        if self.state.get("_journal_seq") is not None:
+            self.journal_seq = self.state["_journal_seq"]
+            del(self.state["_journal_seq"])
 
+        # Replay the journal even if it's turned off now, it may have changes newer than the state file
+        self.__replay_journal()
+        if STATE_JOURNAL:
+            self.dstate.start_journal()
+
+        self.__requeue_emails()
+
+    def __journal_path(self):
+        return os.path.join(self.state_root_path,self.__class__.__name__+".journal")
+
+    # Journal lines are dstate changes, each save ends with ["commit", seq, state]. Only changes
+    # followed by a commit newer than the state file are applied, anything after the last commit
+    # is from a save that didn't finish and is cut off.
+    def __replay_journal(self):
+        journal_path = self.__journal_path()
+        if os.path.exists(journal_path) == False:
+            return
+
+        changes = []
+        replayed = 0
+        good_end = 0
+        pos = 0
+        with open(journal_path, "rb") as f:
+            for line in f:
+                pos += len(line)
+                if line.endswith(b"\n") == False:
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if entry[0] != "commit":
+                    changes.append(entry)
+                    continue
+                if entry[1] > self.journal_seq:
+                    for change in changes:
+                        self.dstate.replay(change)
+                    self.state = entry[2]
+                    self.journal_seq = entry[1]
+                    replayed += 1
+                changes = []
+                good_end = pos
+
+        if good_end < os.path.getsize(journal_path):
+            self.say("Journal has an unfinished save, ignoring the end of it",2)
+            with open(journal_path, "r+b") as f:
+                f.truncate(good_end)
+        if replayed > 0:
+            self.say("Replayed "+str(replayed)+" journal saves",2)
+            # Changes were replayed as they happened, expire the old ones
+            self.dstate.purge()
+
+    def __requeue_emails(self):
         if self.state.get("mail_queue") is None:
             self.state["mail_queue"] = []
 
@@ -147,6 +257,9 @@ class Logmonitor:
     def load_config(self, cfg):
         # self.cfg: Also load from main config file
         self.cfg = cfg
+        # "dstate_storage" picks the storage for the monitor's dlists/ddicts without changing init_dlist/init_ddict calls
+        if cfg.get("dstate_storage") is not None:
+            self.dstate.storage = cfg["dstate_storage"]
         try:
             self.init_cfg()
         except AttributeError:
@@ -156,7 +269,7 @@ class Logmonitor:
                 raise e
             self.print_error(e)
             self.enabled = False
-        
+        self.__init_scan()
 
     def init_state(self, data=dict()):
         for key in data:
@@ -166,55 +279,161 @@ class Logmonitor:
 
 
 
-    def save_state(self):
+    # close=False keeps the sqlite db open (persistent daemon checkpoints), it is only committed
+    def save_state(self, close=True):
         if self.enabled:
             if os.path.exists(self.state_root_path) == False:
                 os.makedirs(self.state_root_path)
-            self.state["_dynamic_state"] = self.dstate.export()
-            state_path = os.path.join(self.state_root_path,self.__class__.__name__)
-            with open(state_path,'w') as f:
+            try:
+                if STATE_JOURNAL and os.path.exists(os.path.join(self.state_root_path,self.__class__.__name__)):
+                    self.__save_journal()
+                else:
+                    self.__save_snapshot()
+            except BaseException as e:
+                if self.debug_modules:
+                    raise e
+                self.print_error(e)
+
+            if self.sqlstate.db is not None:
                 try:
-                    json.dump(self.state,f, indent=4)
+                    if close:
+                        self.sqlstate.close()
+                        out.say("DB Closed "+self.__class__.__name__,2)
+                    else:
+                        self.sqlstate.commit()
                 except BaseException as e:
                     if self.debug_modules:
                         raise e
                     self.print_error(e)
+
+
+    
+
+    # Write the whole state to the state file, then empty the journal since it's all in there now
+    def __save_snapshot(self):
+        self.state["_dynamic_state"] = self.dstate.export()
+        self.state["_journal_seq"] = self.journal_seq
+        state_path = os.path.join(self.state_root_path,self.__class__.__name__)
+        try:
+            statefile.save(state_path, self.state)
+        finally:
             # Don't save this twice in memory, it can be fairly large
             del(self.state["_dynamic_state"])
+            del(self.state["_journal_seq"])
 
-            if self.sqlstate.db is not None:
-                self.sqlstate.close()
-                out.say("DB Closed "+self.__class__.__name__,2)
+        self.dstate.take_journal()
+        journal_path = self.__journal_path()
+        if os.path.exists(journal_path):
+            if STATE_JOURNAL:
+                open(journal_path,'w').close()
+            else:
+                os.remove(journal_path)
+
+    # Append this scan's dstate changes to the journal, one write and fsync per save. The changes are
+    # only taken off the dstate's journal once they're written, a save that fails keeps them.
+    def __save_journal(self):
+        # Dicts and lists in the dstate can be changed in place without a journal entry
+        if self.dstate.has_mutable_values():
+            self.__save_snapshot()
+            return
 
+        lines = []
+        changes = self.dstate.peek_journal()
+        try:
+            for change in changes:
+                lines.append(json.dumps(change))
+            lines.append(json.dumps(["commit", self.journal_seq+1, self.state]))
+        except (TypeError, ValueError):
+            # Not json, the snapshot raises the same error and the changes stay for the next save
+            self.__save_snapshot()
+            return
 
-    
+        journal_path = self.__journal_path()
+        try:
+            with open(journal_path,'a') as f:
+                f.write("\n".join(lines)+"\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            # The journal may now end with part of this save, the state file has everything instead
+            self.print_error(e)
+            self.__save_snapshot()
+            return
+        self.dstate.take_journal()
+        self.journal_seq += 1
+
+        if os.path.getsize(journal_path) > STATE_JOURNAL_COMPACT_SIZE:
+            self.say("Compacting state journal",2)
+            self.__save_snapshot()
 
     #@__trackruntime("handle_log")
+    # Rows are only routed here for readers this monitor uses (see MonitorManager.build_routes)
     def handle_check(self, row, reader):
 
         if self.enabled == False:
             return
-        if reader not in self.readers:
-            return
         try:
             self.check(row)
             self.check_count += 1
+        except logreader.RowParseError:
+            pass
         except BaseException as e:
-            if self.debug_modules:
-                raise e
-            traceback.print_tb(e.__traceback__)
-            msg = "ERROR in "+self.__class__.__name__+"\n"
-            msg += str(traceback.format_exc())
-            self.errors.append(msg)
-            out.error(msg)
-
-            if sys.getsizeof(self.errors) > 104857600:
-                msg = "Too many errors current run: "+str(len(self.errors))
-                out.send_email(config.ERRORS_FROM_ADDRESS, self.EMAIL_ERRORS_TO, "Monitor disabled: "+self.__class__.__name__, msg)
-                self.enabled = False
-                return            
+            self.__check_error(e)
 
+    # Check a chunk of rows. Monitors can define check_batch(rows) to handle a whole chunk at once,
+    # if it raises, the chunk is checked again one row at a time with check(row), so check_batch
+    # should not keep partial changes from a failed chunk.
+    def handle_check_batch(self, rows, reader):
 
+        if self.enabled == False:
+            return
+        try:
+            check_batch = self.check_batch
+        except AttributeError:
+            check_batch = None
+
+        if check_batch is not None:
+            try:
+                check_batch(rows)
+                self.check_count += len(rows)
+                return
+            except BaseException as e:
+                if self.debug_modules:
+                    raise e
+                self.say("check_batch failed, checking rows one at a time: "+str(type(e))+" "+str(e),1)
+
+        # One try block per chunk instead of per row, after an error carry on with the next row
+        check = self.check
+        start = 0
+        while start < len(rows) and self.enabled:
+            i = start
+            try:
+                for i in range(start, len(rows)):
+                    check(rows[i])
+                self.check_count += len(rows) - start
+                return
+            except logreader.RowParseError:
+                # Already a read error of the reader, skip the row
+                self.check_count += i - start
+                start = i + 1
+            except BaseException as e:
+                self.check_count += i - start
+                self.__check_error(e)
+                start = i + 1
+
+    def __check_error(self, e):
+        if self.debug_modules:
+            raise e
+        traceback.print_tb(e.__traceback__)
+        msg = "ERROR in "+self.__class__.__name__+"\n"
+        msg += str(traceback.format_exc())
+        self.errors.append(msg)
+        out.error(msg)
+
+        if sys.getsizeof(self.errors) > 104857600:
+            msg = "Too many errors current run: "+str(len(self.errors))
+            out.send_email(config.ERRORS_FROM_ADDRESS, self.EMAIL_ERRORS_TO, "Monitor disabled: "+self.__class__.__name__, msg)
+            self.enabled = False
 
 
     def handle_complete(self):
@@ -330,64 +549,348 @@ class Logmonitor:
         out.debug(self.__class__.__name__+" "+text)
 
 
-class SQLState:
+# Rows given to SQLState.insert_values are written in batches, once this many are waiting or
+# the oldest has waited this many seconds (and whenever cur is used, or the state is saved)
+try:
+    SQLSTATE_FLUSH_SIZE = config.SQLSTATE_FLUSH_SIZE
+except AttributeError:
+    SQLSTATE_FLUSH_SIZE = 1000
+
+try:
+    SQLSTATE_FLUSH_INTERVAL = config.SQLSTATE_FLUSH_INTERVAL
+except AttributeError:
+    SQLSTATE_FLUSH_INTERVAL = 5
+
+# Open the monitor dbs in WAL mode, writes don't rewrite pages through a rollback journal
+try:
+    SQLSTATE_WAL = config.SQLSTATE_WAL
+except AttributeError:
+    SQLSTATE_WAL = True
+
+# Expired rows are deleted from each init_table table every scan, through the logalerts_expire index,
+# SQLSTATE_PURGE_CHUNK rows per delete (and per transaction, unless the db is shared)
+try:
+    SQLSTATE_PURGE_CHUNK = config.SQLSTATE_PURGE_CHUNK
+except AttributeError:
+    SQLSTATE_PURGE_CHUNK = 10000
+
+# Keep the sqlstate tables of the monitors with sqlstate_shared set in one db (SQLSTATE_SHARED_PATH, or
+# logalerts.sqlite in STATE_ROOT_PATH) through one connection, with the tables named <monitor>__<table>.
+# Everything is committed at once when the monitors are saved instead of once per monitor.
+try:
+    SQLSTATE_SHARED = config.SQLSTATE_SHARED
+except AttributeError:
+    SQLSTATE_SHARED = False
+
+try:
+    SQLSTATE_SHARED_PATH = config.SQLSTATE_SHARED_PATH
+except AttributeError:
+    SQLSTATE_SHARED_PATH = os.path.join(config.STATE_ROOT_PATH, "logalerts.sqlite")
+
+# Seconds to wait for another process (monitor workers) to finish writing to a db
+try:
+    SQLSTATE_BUSY_TIMEOUT = config.SQLSTATE_BUSY_TIMEOUT
+except AttributeError:
+    SQLSTATE_BUSY_TIMEOUT = 60
+
+def connect_sqlite(path):
+    db = sqlite3.connect(path, timeout=SQLSTATE_BUSY_TIMEOUT)
+    cur = db.cursor()
+    if SQLSTATE_WAL:
+        cur.execute("PRAGMA journal_mode=WAL")
+        # Only fsync at checkpoints, a crash can lose the last commits but not corrupt the db
+        cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA cache_size=-20000")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    return db
+
+
+class SharedDB:
+    # The connection used by every SQLState when SQLSTATE_SHARED is on. Forked monitor workers open
+    # their own, a sqlite connection can't be used from two processes.
 
     def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.pid = None
+
+    def connect(self):
+        if self.db is None or self.pid != os.getpid():
+            if os.path.exists(os.path.dirname(self.path)) == False:
+                os.makedirs(os.path.dirname(self.path))
+            self.db = connect_sqlite(self.path)
+            self.pid = os.getpid()
+        return self.db
+
+    def commit(self, close=False):
+        if self.db is None or self.pid != os.getpid():
+            return
+        self.db.commit()
+        if close:
+            self.db.close()
+            self.db = None
+
+shared_db = SharedDB(SQLSTATE_SHARED_PATH)
+
+# Called by MonitorManager once all the monitors are saved
+def commit_shared_db(close=False):
+    if SQLSTATE_SHARED:
+        shared_db.commit(close)
+
+
+# Names in the table and index definitions from sqlite_master, to copy them under new names
+SQL_CREATE_TABLE = re.compile(r'^(CREATE\s+TABLE\s+)("(?:[^"]|"")*"|\[[^\]]*\]|`[^`]*`|[^\s(]+)', re.I)
+SQL_CREATE_INDEX = re.compile(r'^(CREATE\s+(?:UNIQUE\s+)?INDEX\s+)("(?:[^"]|"")*"|\[[^\]]*\]|`[^`]*`|\S+)(\s+ON\s+)("(?:[^"]|"")*"|\[[^\]]*\]|`[^`]*`|[^\s(]+)', re.I)
+
+def quote_sql_name(name):
+    return '"'+name.replace('"', '""')+'"'
+
+
+class SQLState:
+
+    # prefix: put in front of table names, to keep monitors' tables apart in the shared db
+    # own_path: the monitor's db from before the db was shared, its tables are copied into the shared db
+    def __init__(self, path, prefix="", shared=False, own_path=None):
         self.db = None
-        self.cur = None
+        self.db_cur = None
+        self.own_path = own_path
+        self.pid = None
         self.db_path = path
+        self.prefix = prefix
+        self.shared = shared
         self.expires = {}
+        self.columns = {}
+        self.insert_sql = {}
+        self.pending = {}
+        self.pending_count = 0
+        self.pending_since = None
+
+    # Monitors query through cur, so rows still waiting in insert_values are written first
+    @property
+    def cur(self):
+        self.connect()
+        if self.pending_count > 0:
+            self.flush()
+        return self.db_cur
+
+    # The shared db is committed once for all the monitors (commit_shared_db), everything a monitor
+    # does in it is kept in that transaction. Otherwise each statement outside of one commits by itself.
+    def __begin(self):
+        if self.shared and self.db.in_transaction == False:
+            self.db_cur.execute("BEGIN")
+
+    def __commit(self):
+        if self.shared == False:
+            self.db.commit()
+
+    # Name of a table in the db, use this in queries so they work with the shared db too (sqlstate_shared)
+    def table(self, table_name):
+        return self.prefix+table_name
 
     # Ensure database is loaded, initialize a table (basically create it if it doesn't exist)
-    def init_table(self, table_name, schema, expire=0):
-        if self.db == None:
-            self.__load_sqlstate()
+    # indexes: columns to index, each one a column name or a list of columns for one index on all of them
+    def init_table(self, table_name, schema, expire=0, indexes=None):
+        self.connect()
+        table_name = self.table(table_name)
 
         # Ensure table exists with expire column for when the data should be purged
-        self.cur.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='%s'" % (table_name))
-        if self.cur.fetchone()[0] < 1:        
-            self.cur.execute("CREATE TABLE "+table_name+" ("+schema+", logalerts_expire integer)")
-            self.cur.execute("INSERT INTO logalerts_expire VALUES (?,?)", (table_name,expire))
-            self.db.commit()
+        self.db_cur.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
+        if self.db_cur.fetchone()[0] < 1:        
+            self.db_cur.execute("CREATE TABLE "+table_name+" ("+schema+", logalerts_expire integer)")
+            self.db_cur.execute("INSERT INTO logalerts_expire VALUES (?,?)", (table_name,expire))
+            self.__commit()
+
+        # Older tables are given the index here too
+        self.db_cur.execute("CREATE INDEX IF NOT EXISTS "+table_name+"_logalerts_expire ON "+table_name+" (logalerts_expire)")
+        for index in indexes or []:
+            if type(index) == str:
+                index = [index]
+            self.db_cur.execute("CREATE INDEX IF NOT EXISTS "+table_name+"_"+"_".join(index)+" ON "+table_name+" ("+",".join(index)+")")
 
         # Add the expire value to the dictionary so it can be easily used later
-        self.cur.execute("SELECT table_name, expire FROM logalerts_expire WHERE table_name = ?", (table_name,))
-        row = self.cur.fetchone()
+        self.db_cur.execute("SELECT table_name, expire FROM logalerts_expire WHERE table_name = ?", (table_name,))
+        row = self.db_cur.fetchone()
         self.expires[row[0]] = row[1]
+        self.db_cur.execute("PRAGMA table_info("+table_name+")")
+        self.columns[table_name] = len(self.db_cur.fetchall())
 
+        self.__purge(table_name)
+        self.__commit()
 
-        # Purge all data older than the expire time
-        self.cur.execute("DELETE FROM "+table_name+" WHERE logalerts_expire != 0 AND logalerts_expire < ?",(int(time.time()),))
-        # print("Purged rows: "+str(self.cur.rowcount))
-        self.db.commit()
-
+    # Purge every table set up with init_table, for monitors kept loaded between scans
+    def purge_tables(self):
+        if len(self.expires) == 0:
+            return
+        self.connect()
+        for table_name in self.expires:
+            self.__purge(table_name)
+
+    # Delete expired rows, monitors can count the rows in a table as a time window
+    def purge(self, table_name):
+        self.connect()
+        self.__purge(self.table(table_name))
+
+    def __purge(self, table_name):
+        now = int(time.time())
+        while True:
+            # Uses the logalerts_expire index, 0 is never expired. Finding nothing to delete is one index lookup.
+            self.db_cur.execute("DELETE FROM "+table_name+" WHERE rowid IN (SELECT rowid FROM "+table_name+
+                " WHERE logalerts_expire > 0 AND logalerts_expire < ? LIMIT ?)", (now, SQLSTATE_PURGE_CHUNK))
+            deleted = self.db_cur.rowcount
+            self.__commit()
+            if deleted < SQLSTATE_PURGE_CHUNK:
+                break
+
+    # Rows are written later by flush, so they're checked here for the caller to get the error
     def insert_values(self, table_name, values):
+        table_name = self.table(table_name)
+        if len(values)+1 != self.columns[table_name]:
+            raise ValueError(table_name+" has "+str(self.columns[table_name]-1)+" columns, insert_values was given "+str(len(values))+" values")
 
         if self.expires[table_name] == 0:
-            values.append(0)
+            row = tuple(values) + (0,)
         else:
-            values.append(int(time.time())+self.expires[table_name])
-
-        cols = ""
-        for i in range(1,len(values)):
-            cols += "?,"
-        cols += "?"
-        self.cur.execute("insert into "+table_name+" values ("+cols+")",values)
+            row = tuple(values) + (int(time.time())+self.expires[table_name],)
+
+        if self.pending.get(table_name) is None:
+            self.pending[table_name] = []
+        self.pending[table_name].append(row)
+        self.pending_count += 1
+        if self.pending_since is None:
+            self.pending_since = time.time()
+
+        if self.pending_count >= SQLSTATE_FLUSH_SIZE or time.time() - self.pending_since >= SQLSTATE_FLUSH_INTERVAL:
+            self.flush()
+
+    # Write the waiting rows, one executemany per table. Nothing is committed, that's done once
+    # when the monitor is saved (or for all the monitors, with the shared db). If a table's rows
+    # don't all go in, they're inserted one at a time and the ones that failed are reported.
+    def flush(self):
+        if self.pending_count == 0:
+            return
+        # Taken off first so rows that fail to insert aren't retried on every flush
+        pending = self.pending
+        self.pending = {}
+        self.pending_count = 0
+        self.pending_since = None
+        self.connect()
+        cur = self.db_cur
+        failed = []
+        for table_name in pending:
+            rows = pending[table_name]
+            if len(rows) == 0:
+                continue
+            sql = self.insert_sql.get(table_name)
+            if sql is None or sql[0] != len(rows[0]):
+                sql = (len(rows[0]), "INSERT INTO "+table_name+" VALUES ("+",".join(["?"] * len(rows[0]))+")")
+                self.insert_sql[table_name] = sql
+            # Releasing the savepoint would commit if it had started the transaction itself
+            if self.db.in_transaction == False:
+                cur.execute("BEGIN")
+            cur.execute("SAVEPOINT logalerts_flush")
+            try:
+                cur.executemany(sql[1], rows)
+            except sqlite3.Error:
+                cur.execute("ROLLBACK TO logalerts_flush")
+                for row in rows:
+                    try:
+                        cur.execute(sql[1], row)
+                    except sqlite3.Error as e:
+                        failed.append(table_name+" "+str(row)+": "+str(e))
+            cur.execute("RELEASE logalerts_flush")
+        if len(failed) > 0:
+            raise sqlite3.IntegrityError(str(len(failed))+" rows could not be inserted:\n"+"\n".join(failed[:25]))
 
     def __load_sqlstate(self):
-        self.db = sqlite3.connect(self.db_path)
-        self.cur = self.db.cursor()
+        if self.shared:
+            self.db = shared_db.connect()
+        else:
+            self.db = connect_sqlite(self.db_path)
+        self.pid = os.getpid()
+        self.db_cur = self.db.cursor()
+        self.__begin()
 
         # If new, create table to track expire times for other future tables
-        self.cur.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='logalerts_expire'")
-        if self.cur.fetchone()[0] < 1:        
-            self.cur.execute("CREATE TABLE logalerts_expire (table_name text, expire integer)")
-            self.db.commit()
-
-
+        self.db_cur.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='logalerts_expire'")
+        if self.db_cur.fetchone()[0] < 1:        
+            self.db_cur.execute("CREATE TABLE logalerts_expire (table_name text, expire integer)")
+        self.__commit()
+
+        if self.shared and self.own_path is not None and os.path.exists(self.own_path):
+            # Monitors whose own db was already copied in
+            self.db_cur.execute("CREATE TABLE IF NOT EXISTS logalerts_copied (prefix text PRIMARY KEY)")
+            self.db_cur.execute("SELECT count(*) FROM logalerts_copied WHERE prefix = ?", (self.prefix,))
+            if self.db_cur.fetchone()[0] == 0:
+                self.__copy_own_db()
+
+    # The first time a monitor uses the shared db, its tables and indexes are copied in from its own db
+    # so turning on sqlstate_shared doesn't lose them. The old db file is left as it is. Views and
+    # triggers aren't copied, their definitions would still use the old table names.
+    def __copy_own_db(self):
+        own = sqlite3.connect(self.own_path)
+        self.db_cur.execute("SAVEPOINT logalerts_copy")
+        try:
+            own_cur = own.cursor()
+            own_cur.execute("SELECT type, name, tbl_name, sql FROM sqlite_master WHERE sql IS NOT NULL ORDER BY type = 'table' DESC")
+            tables = []
+            for object_type, name, table_name, sql in own_cur.fetchall():
+                if table_name.startswith("logalerts_"):
+                    continue
+                if object_type == "table":
+                    match = SQL_CREATE_TABLE.match(sql)
+                    self.db_cur.execute(match.group(1)+quote_sql_name(self.table(name))+sql[match.end():])
+                    tables.append(name)
+                elif object_type == "index":
+                    match = SQL_CREATE_INDEX.match(sql)
+                    self.db_cur.execute(match.group(1)+quote_sql_name(self.table(name))+match.group(3)+quote_sql_name(self.table(table_name))+sql[match.end():])
+                else:
+                    print("Not copied into the shared db, "+object_type+" "+name+" from "+self.own_path)
+
+            for name in tables:
+                rows = own.execute("SELECT * FROM "+quote_sql_name(name))
+                columns = len(rows.description)
+                self.db_cur.executemany("INSERT INTO "+quote_sql_name(self.table(name))+" VALUES ("+",".join(["?"] * columns)+")", rows)
+            own_cur.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='logalerts_expire'")
+            if own_cur.fetchone()[0] > 0:
+                for table_name, expire in own.execute("SELECT table_name, expire FROM logalerts_expire"):
+                    self.db_cur.execute("INSERT INTO logalerts_expire VALUES (?,?)", (self.table(table_name), expire))
+            self.db_cur.execute("INSERT INTO logalerts_copied VALUES (?)", (self.prefix,))
+        except BaseException:
+            # Only this copy is undone, not what the other monitors did in the shared transaction
+            self.db_cur.execute("ROLLBACK TO logalerts_copy")
+            raise
+        finally:
+            self.db_cur.execute("RELEASE logalerts_copy")
+            own.close()
+        out.say("Copied "+str(len(tables))+" sqlstate tables from "+self.own_path+" into the shared db, the old file is no longer used")
+
+    # Rows that could be inserted are still committed when flush reports some that couldn't
     def __save_sqlstate(self):
-        self.db.commit()
-        self.db.close()
+        try:
+            self.flush()
+        finally:
+            if self.shared == False:
+                self.db.commit()
+                self.db.close()
+            self.db = None
+            self.db_cur = None
+
+    # Open the db if it isn't already, for tables not made with init_table (sqlite dstate). A forked
+    # monitor worker opens its own instead of using the one it inherited.
+    def connect(self):
+        if self.db == None or self.pid != os.getpid() or (self.shared and self.db is not shared_db.connect()):
+            self.__load_sqlstate()
+        self.__begin()
+        return self.db
+
+    def commit(self):
+        if self.db is not None:
+            try:
+                self.flush()
+            finally:
+                if self.shared == False:
+                    self.db.commit()
 
     def close(self):
         self.__save_sqlstate()
@@ -6,9 +6,71 @@ import time
 import datetime
 import glob
 import hashlib
+import re
+import mmap
+import gzip
+import bz2
+import lzma
+import zlib
+import multiprocessing
+import signal
 sys.path.append(os.path.join(os.path.dirname(__file__), "../"))
 import config
 import output as out
+import statefile
+
+# Default number of worker processes used to parse each reader's files, readers can
+# override it with "workers" in their config. 0 or 1 parses in the main process.
+try:
+    READER_WORKERS = config.READER_WORKERS
+except AttributeError:
+    READER_WORKERS = 0
+
+# Default for memory mapping files and prefiltering raw bytes, readers can override with "mmap"
+try:
+    READER_MMAP = config.READER_MMAP
+except AttributeError:
+    READER_MMAP = False
+
+# Compressed files are decompressed in blocks of this size
+try:
+    READER_BLOCK_SIZE = config.READER_BLOCK_SIZE
+except AttributeError:
+    READER_BLOCK_SIZE = 4194304
+
+# Compressed files are recognised by their magic bytes, not by their names
+COMPRESSION_MAGIC = [
+    (b"\x1f\x8b", "gzip", gzip.open),
+    (b"BZh", "bz2", bz2.open),
+    (b"\xfd7zXZ\x00", "xz", lzma.open)
+]
+
+def compression_type(path):
+    try:
+        with open(path, "rb") as f:
+            magic = f.read(6)
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+    for compression in COMPRESSION_MAGIC:
+        if magic.startswith(compression[0]):
+            return compression[1]
+    return None
+
+def open_compressed(path, compression):
+    for c in COMPRESSION_MAGIC:
+        if c[1] == compression:
+            return c[2](path, "rb")
+
+# Tail mode remembers a checksum of everything read from each file, to recognise an archive that was
+# compressed from a file that was already read. A hash of this many bytes from the start of the file
+# picks out the archives worth checksumming.
+ARCHIVE_HEAD_SIZE = 1024
+
+# Size of the byte ranges handed to each worker
+try:
+    READER_CHUNK_SIZE = config.READER_CHUNK_SIZE
+except AttributeError:
+    READER_CHUNK_SIZE = 16777216
 
 
 class Logreader:
@@ -38,8 +100,7 @@ class Logreader:
     def __load_state(self):
         state_path = os.path.join(self.state_root_path,self.__class__.__name__)
         try:
-            with open(state_path) as f:
-                self.state = json.load(f)
+            self.state = statefile.load(state_path)
         except FileNotFoundError:
             self.state = {
                 "reader_name" : self.__class__.__name__,
@@ -56,13 +117,12 @@ class Logreader:
             if os.path.exists(self.state_root_path) == False:
                 os.makedirs(self.state_root_path)
             state_path = os.path.join(self.state_root_path,self.__class__.__name__)
-            with open(state_path,'w') as f:
-                try:
-                    json.dump(self.state,f, indent=4)
-                except BaseException as e:
-                    if self.debug_modules:
-                        raise e
-                    self.print_error(e)
+            try:
+                statefile.save(state_path, self.state)
+            except BaseException as e:
+                if self.debug_modules:
+                    raise e
+                self.print_error(e)
 
 
     def print_error(self,e):
@@ -72,17 +132,115 @@ class Logreader:
         print(error_msg)
 
 
+# Raised when a LazyRow field can't be parsed. It's already counted as a read error of the reader,
+# monitors skip the row instead of counting it as their own error.
+class RowParseError(ValueError):
+    pass
+
+
+class LazyRow(dict):
+    # Works like the dict json_row returns, but keeps the raw line and parses each field the first
+    # time it's used. Anything that needs the whole row (keys, items, iterating, json, pickling to
+    # worker processes, comparing) parses all the fields first.
+    __slots__ = ("line", "fields", "reader", "error")
+
+    def __init__(self, line, fields, reader):
+        super().__init__()
+        self.line = line
+        self.fields = fields
+        self.reader = reader
+        self.error = None
+
+    def __missing__(self, key):
+        if self.error is not None:
+            raise self.error
+        parse = self.fields[key]
+        try:
+            value = parse(self.line)
+        except BaseException as e:
+            if self.reader.debug_modules:
+                raise e
+            # Goes to the reader's errors like a line parse_row failed on, once per row
+            self.reader.row_error(self.line)
+            self.error = RowParseError("Can't parse "+key+" in line: "+self.line)
+            raise self.error from e
+        self[key] = value
+        return value
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.fields
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def materialize(self):
+        for key in self.fields:
+            if dict.__contains__(self, key) == False:
+                self.__missing__(key)
+        return self
+
+    def keys(self):
+        return dict.keys(self.materialize())
+
+    def values(self):
+        return dict.values(self.materialize())
+
+    def items(self):
+        return dict.items(self.materialize())
+
+    def __iter__(self):
+        return dict.__iter__(self.materialize())
+
+    def __len__(self):
+        return dict.__len__(self.materialize())
+
+    def __eq__(self, other):
+        return dict.__eq__(self.materialize(), other)
+
+    def __ne__(self, other):
+        return dict.__ne__(self.materialize(), other)
+
+    def __repr__(self):
+        return dict.__repr__(self.materialize())
+
+    def copy(self):
+        return dict(self.materialize())
+
+    # A row with a field that doesn't parse arrives as None, which the monitors skip
+    def __reduce__(self):
+        try:
+            return (dict, (self.copy(),))
+        except RowParseError:
+            return (type(None), ())
+
+
 class Filereader(Logreader):
 
     temp_log_root = config.TEMP_ROOT_PATH
-    initialized_log_files = []
+    initialized_log_files = set()
+
+    # Readers can define row_fields instead of json_row to get lazy rows, a dict of field name ->
+    # function(line) returning the value. Fields are only parsed when a monitor uses them.
+    # accept_line(line) can be overridden to return False for lines that aren't rows.
+    row_fields = None
 
     def __init__(self):
         super().__init__()
         self.temp_files = []
+        # (path, start offset, end offset) for each file to read, end of None reads the whole file
+        self.sources = []
+        self.tailed_files = set()
+        self.pending_offsets = {}
+        self.needs_hup = True
         self.runtimes = {}
         self.read_count = 0
         self.none_count = 0
+        self.skip_count = 0
+        self.prefilter = None
+        self.prefilter_bytes = None
+        self.prefilter_pattern = None
         self.current_timestamp = int(time.time())
         self.current_datetime = datetime.datetime.today()
         self.errors = []
@@ -92,6 +250,19 @@ class Filereader(Logreader):
         except AttributeError:
             self.copy_instead_of_move = False
 
+    # Only called when the reader is kept loaded between scans (persistent daemon)
+    def begin_scan(self):
+        self.temp_files = []
+        self.sources = []
+        self.tailed_files = set()
+        self.pending_offsets = {}
+        self.read_count = 0
+        self.none_count = 0
+        self.skip_count = 0
+        self.current_timestamp = int(time.time())
+        self.current_datetime = datetime.datetime.today()
+        self.errors = []
+
         
     # Decorator to be used to keep track of how long functions take
     def __trackruntime(totaltime):
@@ -106,6 +277,27 @@ class Filereader(Logreader):
             return wrapper
         return inner
 
+    def parse_row(self, line):
+        if self.row_fields is None:
+            return self.json_row(line)
+        if self.accept_line(line) == False:
+            return None
+        return LazyRow(line, self.row_fields, self)
+
+    def accept_line(self, line):
+        return True
+
+    # Regex built from the prefilters of the monitors reading from this reader (see MonitorManager),
+    # lines that don't match are skipped without being parsed
+    def set_prefilter(self, pattern):
+        self.prefilter_pattern = pattern
+        if pattern is None:
+            self.prefilter = None
+            self.prefilter_bytes = None
+        else:
+            self.prefilter = re.compile(pattern)
+            self.prefilter_bytes = re.compile(pattern.encode())
+
     def initialize(self):
         
         if self.state["last_error_count"] > 1000:
@@ -120,9 +312,24 @@ class Filereader(Logreader):
             self.enabled = False
             return
 
+        log_files = self.__expand_files(log_files)
+        if self.state.get("offsets") is None:
+            self.state["offsets"] = {}
+        self.tailed_files = set(log_files)
+
+        if self.cfg.get("mode") == "tail":
+            self.needs_hup = False
+            self.initialize_tail(log_files)
+            return
+
         # If I decide to use glob.glob, could concat results together so that readers could share those
         for log_file in log_files:
-            
+
+            # Compressed archives are read in place and never moved, they are usually logs kept by logrotate
+            if compression_type(log_file) is not None:
+                self.__add_compressed(log_file, os.stat(log_file))
+                continue
+
             temp_file = self.__get_temp_filepath(log_file)
             # Check if another reader already initialized this file
             if temp_file in self.initialized_log_files:
@@ -151,51 +358,397 @@ class Filereader(Logreader):
             self.temp_files.append(temp_file)
 
             # Store in global list so other readers can share the file
-            self.initialized_log_files.append(temp_file)
-            
+            self.initialized_log_files.add(temp_file)
 
-    def read(self):
-        for log_file in self.temp_files:
-            with open(log_file, errors="replace") as f:
+        for temp_file in self.temp_files:
+            self.sources.append((temp_file, 0, None))
+
+    # Entries in "files" can be glob patterns, ex: to pick up rotated or archived logs
+    def __expand_files(self, log_files):
+        files = []
+        for log_file in log_files:
+            if glob.has_magic(log_file):
+                files += sorted(glob.glob(log_file))
+            else:
+                files.append(log_file)
+        return files
+
+    # Tail mode, read the log files in place starting from the offset saved in the state on the
+    # last run. Files are tracked by device and inode so rotation and truncation can be detected.
+    def initialize_tail(self, log_files):
+        offsets = self.state["offsets"]
+
+        # Files can be renamed to another tracked name when they are rotated, ex: with a glob
+        renamed_files = {}
+        for path in offsets:
+            renamed_files[(offsets[path]["dev"], offsets[path]["ino"])] = offsets[path]
+
+        for log_file in log_files:
+            try:
+                stat = os.stat(log_file)
+            except FileNotFoundError:
+                print("Skipping, file doesn't exist: "+log_file)
+                continue
+
+            start = 0
+            # The entry the read continues from
+            previous = None
+            saved = offsets.get(log_file)
+            renamed = renamed_files.get((stat.st_dev, stat.st_ino))
+
+            if compression_type(log_file) is not None:
+                self.__add_compressed(log_file, stat)
+                continue
+
+            if saved is not None and saved["dev"] == stat.st_dev and saved["ino"] == stat.st_ino:
+                if stat.st_size >= saved["offset"]:
+                    start = saved["offset"]
+                    previous = saved
+                else:
+                    print("Log file was truncated, reading from the start: "+log_file)
+            elif renamed is not None and stat.st_size >= renamed["offset"]:
+                start = renamed["offset"]
+                previous = renamed
+            elif saved is not None:
+                # Rotated, finish reading the old file if it can still be found
+                rotated_file = self.__find_rotated_file(log_file, saved)
+                if rotated_file is not None and rotated_file not in self.tailed_files:
+                    end = self.__last_line_end(rotated_file, saved["offset"], os.path.getsize(rotated_file))
+                    if end > saved["offset"]:
+                        self.sources.append((rotated_file, saved["offset"], end))
+
+            # Only read up to the last complete line, the rest is picked up next time
+            end = self.__last_line_end(log_file, start, stat.st_size)
+            if end > start:
+                self.sources.append((log_file, start, end))
+            self.pending_offsets[log_file] = {
+                "dev"       : stat.st_dev,
+                "ino"       : stat.st_ino,
+                "offset"    : end
+            }
+            if end > 0:
+                with open(log_file, "rb") as f:
+                    head = f.read(min(end, ARCHIVE_HEAD_SIZE))
+                self.pending_offsets[log_file]["head"] = hashlib.md5(head).hexdigest()
+                self.pending_offsets[log_file]["head_size"] = len(head)
+                # Only the new part is checksummed, continuing from the saved checksum
+                if previous is not None and previous.get("crc") is not None:
+                    self.pending_offsets[log_file]["crc"] = self.__crc(log_file, start, end, previous["crc"])
+                else:
+                    self.pending_offsets[log_file]["crc"] = self.__crc(log_file, 0, end, 0)
+
+    def __crc(self, path, start, end, crc):
+        with open(path, "rb") as f:
+            f.seek(start)
+            pos = start
+            while pos < end:
+                block = f.read(min(READER_BLOCK_SIZE, end - pos))
+                if not block:
+                    break
+                crc = zlib.crc32(block, crc)
+                pos += len(block)
+        return crc
+
+    # Compressed archives are read in place, "offset" is the compressed size that was read so they
+    # are only read once, even if they are renamed
+    def __add_compressed(self, log_file, stat):
+        offsets = self.state["offsets"]
+        for path in offsets:
+            saved = offsets[path]
+            if saved["dev"] == stat.st_dev and saved["ino"] == stat.st_ino and saved["offset"] == stat.st_size:
+                self.pending_offsets[log_file] = saved
+                return
+
+        self.sources.append((log_file, self.__compressed_start(log_file, offsets), None))
+        self.pending_offsets[log_file] = {
+            "dev"       : stat.st_dev,
+            "ino"       : stat.st_ino,
+            "offset"    : stat.st_size
+        }
+
+    # Where to start reading an archive, in decompressed bytes. When logrotate renames a file and
+    # compresses it later, the archive is a new inode with lines that were already tailed. It's matched
+    # to the file it came from when everything read from that file (its checksum up to its offset) is
+    # the start of the archive, and read from where that file was left. Anything else is read whole.
+    def __compressed_start(self, log_file, offsets):
+        compression = compression_type(log_file)
+        try:
+            with open_compressed(log_file, compression) as f:
+                head = f.read(ARCHIVE_HEAD_SIZE)
+
+            candidates = []
+            for path in offsets:
+                saved = offsets[path]
+                if saved.get("crc") is None or saved["head_size"] > len(head):
+                    continue
+                if hashlib.md5(head[:saved["head_size"]]).hexdigest() == saved["head"]:
+                    candidates.append(saved)
+            if len(candidates) == 0:
+                return 0
+
+            start = 0
+            pos = 0
+            crc = 0
+            with open_compressed(log_file, compression) as f:
+                for saved in sorted(candidates, key=lambda saved: saved["offset"]):
+                    while pos < saved["offset"]:
+                        block = f.read(min(READER_BLOCK_SIZE, saved["offset"] - pos))
+                        if not block:
+                            break
+                        crc = zlib.crc32(block, crc)
+                        pos += len(block)
+                    if pos == saved["offset"] and crc == saved["crc"]:
+                        start = pos
+        except (OSError, EOFError, lzma.LZMAError):
+            # Reported when the archive is read
+            return 0
+
+        if start > 0:
+            print("Compressed file starts with "+str(start)+" bytes that were already read: "+log_file)
+        return start
+
+    def __find_rotated_file(self, log_file, saved):
+        for rotated_file in glob.glob(log_file+"*"):
+            try:
+                stat = os.stat(rotated_file)
+            except FileNotFoundError:
+                continue
+            if saved["dev"] == stat.st_dev and saved["ino"] == stat.st_ino and stat.st_size >= saved["offset"]:
+                return rotated_file
+        return None
+
+    def __last_line_end(self, path, start, size):
+        with open(path, "rb") as f:
+            pos = size
+            while pos > start:
+                block = min(1048576, pos - start)
+                f.seek(pos - block)
+                i = f.read(block).rfind(b"\n")
+                if i != -1:
+                    return pos - block + i + 1
+                pos -= block
+        return start
+
+    def read_lines(self, source):
+        path, start, end = source
+        if start == 0 and end is None:
+            with open(path, errors="replace") as f:
+                for line in f:
+                    yield line
+        else:
+            with open(path, "rb") as f:
+                f.seek(start)
+                pos = start
                 for line in f:
-                    if line != None:
-                        try:
-                            new_row = self.json_row(line.strip())
-                            if new_row is None:
-                                self.none_count += 1
-                                continue
-                            new_row["logreader_name"] = self.__class__.__name__
-                            yield new_row
-                            self.read_count += 1
-                        except BaseException as e:
-                            if self.debug_modules:
-                                raise(e)
-                            msg = "ERROR in "+self.__class__.__name__+" reading line: "+line+"\n"
-                            msg += str(traceback.format_exc())
-                            self.errors.append(msg)
-
-                            # Over 100MB of error text, time to disable
-                            if sys.getsizeof(self.errors) > 104857600:
-                                msg = "Too many errors current run: "+str(len(self.errors))
-                                out.send_email(config.ERRORS_FROM_ADDRESS, self.EMAIL_ERRORS_TO, "Reader disabled: "+self.__class__.__name__, msg)
-                                self.enabled = False
-                                return
-                            
-                            continue
+                    pos += len(line)
+                    if pos > end:
+                        break
+                    yield line.decode(errors="replace")
+
+    # Yields the lines of a source that pass the prefilter, the others are counted in skip_count.
+    # prefilters is a (str regex, bytes regex) pair to use instead of the reader's own.
+    def filtered_lines(self, source, prefilters=None):
+        if prefilters is None:
+            prefilters = (self.prefilter, self.prefilter_bytes)
+
+        compression = compression_type(source[0])
+        if compression is not None:
+            yield from self.__compressed_lines(source, compression, prefilters[1])
+            return
+
+        if self.cfg.get("mmap", READER_MMAP):
+            yield from self.__mmap_lines(source, prefilters[1])
+            return
+
+        prefilter = prefilters[0]
+        for line in self.read_lines(source):
+            if prefilter is not None and prefilter.search(line) is None:
+                self.skip_count += 1
+                continue
+            yield line
+
+    # Memory map the file and split lines on bytes, the prefilter runs on the mapped bytes
+    # and only lines that get through it are decoded
+    def __mmap_lines(self, source, prefilter):
+        path, start, end = source
+        if os.path.getsize(path) == 0:
+            return
+
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if end is None or end > len(m):
+                    end = len(m)
+                pos = start
+                while pos < end:
+                    line_end = m.find(b"\n", pos, end)
+                    if line_end == -1:
+                        line_end = end
+                    if prefilter is not None and prefilter.search(m, pos, line_end) is None:
+                        self.skip_count += 1
                     else:
+                        yield m[pos:line_end].decode(errors="replace")
+                    pos = line_end + 1
+
+    # Stream decompress in large blocks and split on bytes, same as the mmap reader.
+    # The start offset is into the decompressed data. Seeking to it still decompresses everything before
+    # it, only the lines after it are split, filtered and parsed.
+    def __compressed_lines(self, source, compression, prefilter):
+        with open_compressed(source[0], compression) as f:
+            if source[1] > 0:
+                f.seek(source[1])
+            rest = b""
+            while True:
+                block = f.read(READER_BLOCK_SIZE)
+                if not block:
+                    break
+                lines = (rest + block).split(b"\n")
+                rest = lines.pop()
+                for line in lines:
+                    if prefilter is not None and prefilter.search(line) is None:
+                        self.skip_count += 1
                         continue
+                    yield line.decode(errors="replace")
+            if len(rest) > 0:
+                if prefilter is not None and prefilter.search(rest) is None:
+                    self.skip_count += 1
+                else:
+                    yield rest.decode(errors="replace")
+
+    def read(self):
+        if self.read_workers() > 1:
+            yield from self.__read_parallel(self.read_workers())
+        else:
+            for source in self.sources:
+                yield from self.read_source(source)
+                if self.enabled == False:
+                    return
+        self.finish_read()
+
+    def read_workers(self):
+        return self.cfg.get("workers", READER_WORKERS)
+
+    # Called after all sources are read, unless the reader was disabled while reading
+    def finish_read(self):
+        if self.enabled == False:
+            return
 
+        # Tail mode offsets are only moved forward once everything up to them was read
+        if len(self.pending_offsets) > 0:
+            self.state["offsets"].update(self.pending_offsets)
+            self.pending_offsets = {}
+
+            # Forget files that were matched by a glob and are gone now
+            for path in list(self.state["offsets"].keys()):
+                if path not in self.tailed_files and path not in self.cfg["files"] and os.path.exists(path) == False:
+                    del(self.state["offsets"][path])
 
         self.state["last_read_count"] = self.read_count
         self.state["last_none_count"] = self.none_count
+        self.state["last_skip_count"] = self.skip_count
         self.state["last_error_count"] = len(self.errors)
         if self.read_count > 0:
             self.state["last_read_timestamp"] = int(time.time())
-                
+
+    def read_source(self, source):
+        for line in self.filtered_lines(source):
+            new_row = self.parse_line(line)
+            if new_row is not None:
+                yield new_row
+            if self.enabled == False:
+                return
+
+    # Returns the row for a line or None. Errors are saved for cleanup(), too many disables the reader.
+    def parse_line(self, line):
+        try:
+            new_row = self.parse_row(line.strip())
+            if new_row is None:
+                self.none_count += 1
+                return None
+            new_row["logreader_name"] = self.__class__.__name__
+            self.read_count += 1
+            return new_row
+        except BaseException as e:
+            if self.debug_modules:
+                raise(e)
+            msg = "ERROR in "+self.__class__.__name__+" reading line: "+line+"\n"
+            msg += str(traceback.format_exc())
+            self.__add_error(msg)
+            return None
+
+    # A LazyRow field failed to parse after the row was read, it counts as an error instead of a read
+    def row_error(self, line):
+        self.read_count -= 1
+        msg = "ERROR in "+self.__class__.__name__+" reading line: "+line+"\n"
+        msg += str(traceback.format_exc())
+        self.__add_error(msg)
+
+    # Split the files into line aligned byte ranges and parse them in worker processes,
+    # rows come back in file order
+    def __read_parallel(self, workers):
+        ranges = []
+        for source in self.sources:
+            ranges += self.__split_source(source)
+
+        if len(ranges) < 2:
+            for source in self.sources:
+                yield from self.read_source(source)
+                if self.enabled == False:
+                    return
+            return
+
+        # The workers would write out again whatever is still in the log buffers
+        out.flush()
+        context = multiprocessing.get_context("fork")
+        with context.Pool(workers, initializer=_init_read_worker, initargs=(self,)) as pool:
+            for rows, none_count, skip_count, errors in pool.imap(_read_range, ranges):
+                self.none_count += none_count
+                self.skip_count += skip_count
+                for msg in errors:
+                    if self.__add_error(msg) == False:
+                        return
+                self.read_count += len(rows)
+                for row in rows:
+                    yield row
+
+    def __split_source(self, source):
+        path, start, end = source
+        # Compressed streams can't be split, one worker reads the whole file
+        if compression_type(path) is not None:
+            return [source]
+        if end is None:
+            end = os.path.getsize(path)
+        ranges = []
+        with open(path, "rb") as f:
+            while start < end:
+                split = start + READER_CHUNK_SIZE
+                if split < end:
+                    f.seek(split)
+                    split += len(f.readline())
+                split = min(split, end)
+                ranges.append((path, start, split))
+                start = split
+        return ranges
+
+    # Returns False if the reader was disabled for having too many errors
+    def __add_error(self, msg):
+        self.errors.append(msg)
+
+        # Over 100MB of error text, time to disable
+        if sys.getsizeof(self.errors) > 104857600:
+            msg = "Too many errors current run: "+str(len(self.errors))
+            out.send_email(config.ERRORS_FROM_ADDRESS, self.EMAIL_ERRORS_TO, "Reader disabled: "+self.__class__.__name__, msg)
+            self.enabled = False
+            return False
+        return True
 
     # Called once monitors are all done processing. Delete the read log files
     def cleanup(self):
 
+        # Lazy row fields that failed in the monitors were counted after finish_read
+        if self.enabled:
+            self.state["last_read_count"] = self.read_count
+            self.state["last_error_count"] = len(self.errors)
+
         for log_file in self.temp_files:
             try:
                 os.remove(log_file)
@@ -218,8 +771,15 @@ class Filereader(Logreader):
             out.send_email(config.ERRORS_FROM_ADDRESS, self.EMAIL_ERRORS_TO, "Reader errors: "+self.__class__.__name__, "\n".join(email_errors))
 
         try:
+            # Lines dropped by the prefilter were never parsed, the minimums are scaled down to the share of
+            # lines that were. A reader whose parse_row stopped working still reads less than the minimum.
+            parsed = self.read_count + self.none_count + len(self.errors)
+            share = 1
+            if self.skip_count > 0:
+                share = parsed / (parsed + self.skip_count)
+
             # This logic is annoying and duplicated, anymore and it should be re-written using variables or classes
-            if self.watchdog.get("min_read_count") and self.read_count < self.watchdog["min_read_count"]:
+            if self.watchdog.get("min_read_count") and self.read_count < self.watchdog["min_read_count"] * share:
                 self.state["missed_read_watchdogs"] += 1
                 if self.state["missed_read_watchdogs"] > self.watchdog["min_read_runs_allowed"]:
                     msg = "Reader "+self.__class__.__name__+" has read less than "+str(self.watchdog["min_read_count"]) + " matching lines "+str(self.state["missed_read_watchdogs"])+" times."
@@ -227,7 +787,7 @@ class Filereader(Logreader):
             else:
                 self.state["missed_read_watchdogs"] = 0
 
-            if self.watchdog.get("min_none_count") and self.none_count < self.watchdog["min_none_count"]:
+            if self.watchdog.get("min_none_count") and self.none_count < self.watchdog["min_none_count"] * share:
                 self.state["missed_none_watchdogs"] += 1
                 if self.state["missed_none_watchdogs"] > self.watchdog["min_none_runs_allowed"]:
                     msg = "Reader "+self.__class__.__name__+" has read less than "+str(self.watchdog["min_none_count"]) + " \"None\" lines "+str(self.state["missed_none_watchdogs"])+" times."
@@ -256,3 +816,33 @@ class Filereader(Logreader):
     def debug(self,text):
         out.debug(text)
 
+
+# Reader worker processes are forked, so the reader object is inherited instead of pickled
+_worker_reader = None
+
+def _init_read_worker(reader):
+    global _worker_reader
+    _worker_reader = reader
+    # The daemon's SIGTERM handler only marks it for shutdown, the pool stops its workers with SIGTERM
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _read_range(source):
+    reader = _worker_reader
+    rows = []
+    # The parent has the real counts, send back only what this range added
+    none_before = reader.none_count
+    skip_before = reader.skip_count
+    reader.errors = []
+    for line in reader.filtered_lines(source):
+        new_row = reader.parse_line(line)
+        if new_row is None:
+            continue
+        # Lazy rows are parsed here anyway to be sent back, so field errors are counted in this range
+        if isinstance(new_row, LazyRow):
+            try:
+                new_row.materialize()
+            except RowParseError:
+                continue
+        rows.append(new_row)
+    return rows, reader.none_count - none_before, reader.skip_count - skip_before, reader.errors
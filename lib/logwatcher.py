@@ -0,0 +1,127 @@
+import os,sys
+import ctypes
+import ctypes.util
+import struct
+import select
+import fnmatch
+import time
+
+# Linux inotify through ctypes, used by the daemon to start a scan when log files are written
+# instead of waking up every DAEMON_INTERVAL.
+
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "inotify_init1 failed: "+os.strerror(errno))
+        self.watches = {}
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "inotify_add_watch failed for "+path+": "+os.strerror(errno))
+        self.watches[wd] = path
+        return wd
+
+    # Returns a list of (watched path, name, mask), waits at most timeout seconds for the first event
+    def read_events(self, timeout):
+        ready = select.select([self.fd], [], [], timeout)[0]
+        if len(ready) == 0:
+            return []
+
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos + EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+                pos += EVENT_HEADER.size
+                name = data[pos:pos+length].rstrip(b"\0").decode(errors="replace")
+                pos += length
+                events.append((self.watches.get(wd), name, mask))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class LogWatcher:
+
+    # IN_CREATE is left out, syslog re-creating an empty file after the HUP is not new data
+    mask = IN_MODIFY | IN_MOVED_TO
+
+    # debounce: wait this long after the last write before scanning
+    # max_latency: never wait longer than this after the first write
+    # idle_interval: scan anyway after this long so daily runs and watchdogs still happen
+    def __init__(self, log_files, debounce=2, max_latency=10, idle_interval=600):
+        self.debounce = debounce
+        self.max_latency = max_latency
+        self.idle_interval = idle_interval
+        self.first_event = None
+        self.last_event = None
+        self.last_scan = 0
+
+        # Watch directories, not files, so rotated and re-created files are still seen
+        self.patterns = {}
+        for log_file in log_files:
+            directory = os.path.dirname(os.path.abspath(log_file))
+            if self.patterns.get(directory) is None:
+                self.patterns[directory] = []
+            self.patterns[directory].append(os.path.basename(log_file))
+
+        self.inotify = Inotify()
+        for directory in self.patterns:
+            if os.path.isdir(directory):
+                self.inotify.add_watch(directory, self.mask)
+
+    def watched(self, directory, name):
+        for pattern in self.patterns.get(directory, []):
+            if fnmatch.fnmatchcase(name, pattern):
+                return True
+        return False
+
+    # Blocks for at most timeout seconds, returns True when it's time to scan
+    def ready(self, timeout=1):
+        for directory, name, mask in self.inotify.read_events(timeout):
+            # Overflowed queue means events were lost, just scan
+            if mask & IN_Q_OVERFLOW or self.watched(directory, name):
+                now = time.time()
+                if self.first_event is None:
+                    self.first_event = now
+                self.last_event = now
+
+        now = time.time()
+        if self.first_event is not None:
+            if now - self.last_event >= self.debounce or now - self.first_event >= self.max_latency:
+                return True
+        if now - self.last_scan >= self.idle_interval:
+            return True
+        return False
+
+    def scanned(self):
+        self.first_event = None
+        self.last_event = None
+        self.last_scan = time.time()
+
+    def close(self):
+        self.inotify.close()
@@ -1,4 +1,5 @@
 import os,sys
+import re
 from collections import OrderedDict
 import datetime
 import logreaders
@@ -7,9 +8,24 @@ import logmonitors
 import logmonitors_custom
 import output as out
 import logreader
+import logmonitor
+import monitorpool
+from monitorpool import MONITOR_BATCH_SIZE
 sys.path.append(os.path.join(os.path.dirname(__file__), "../"))
 import config
 
+# Split monitors across this many worker processes, 0 or 1 runs them all in the main process
+try:
+    MONITOR_WORKERS = config.MONITOR_WORKERS
+except AttributeError:
+    MONITOR_WORKERS = 0
+
+# Rows are handed to monitors in chunks of this many (see Logmonitor.handle_check_batch)
+try:
+    CHECK_BATCH_SIZE = config.CHECK_BATCH_SIZE
+except AttributeError:
+    CHECK_BATCH_SIZE = 2000
+
 LOGMONITOR_LIBRARIES = [logmonitors, logmonitors_custom]
 LOGREADER_LIBRARIES = [logreaders, logreaders_custom]
 
@@ -69,8 +85,11 @@ def load_module(mod_name, mod_type, cfg):
 
 class ModuleManager:
 
+    module_type = None
+
     def __init__(self):
         self.disabled_modules = set()
+        self.disabled_on_load = set()
         self.loaded_modules = OrderedDict()
 
     def load_modules(self, modules, modules_name, enabled_list=None):
@@ -85,8 +104,36 @@ class ModuleManager:
                 if module.enabled:
                     out.say("Module loaded: "+mod_name,2)
                 else:
+                    self.disabled_on_load.add(mod_name)
                     out.say("Module was disabled on load: "+mod_name,1)
 
+    # Used by the persistent daemon, where modules stay loaded between scans. Modules that got
+    # disabled during the last scan are reloaded from their saved state, like a new scan would do.
+    def begin_scan(self):
+        out.reset_mail_server()
+        for mod_name in list(self.loaded_modules):
+            module = self.loaded_modules[mod_name]
+            if module.enabled == False and mod_name not in self.disabled_on_load:
+                if self.reload_module(mod_name) is not None:
+                    out.say("Module reloaded: "+mod_name,1)
+                continue
+            if module.enabled:
+                module.begin_scan()
+
+    # Load a module again from its saved state, None if it doesn't load anymore (then it's dropped)
+    def reload_module(self, mod_name):
+        module = load_module(mod_name, self.module_type, self.enabled_list[mod_name])
+        if module is None:
+            del(self.loaded_modules[mod_name])
+            return None
+        self.loaded_modules[mod_name] = module
+        return module
+
+    # Load all the modules again, used by monitor workers that are kept between scans (see MonitorPool.attach)
+    def reload_modules(self):
+        for mod_name in list(self.loaded_modules):
+            self.reload_module(mod_name)
+
     def get_active(self):
         active_modules = dict()
         for mod_name in self.loaded_modules:
@@ -101,6 +148,8 @@ class ModuleManager:
 
 class ReaderManager(ModuleManager):
 
+    module_type = "reader"
+
     def __init__(self):
         super().__init__()
         try:
@@ -109,7 +158,77 @@ class ReaderManager(ModuleManager):
             self.enabled_list = None
         for library in LOGREADER_LIBRARIES:
             self.load_modules(library,"reader", self.enabled_list)
-        logreader.Filereader.initialized_log_files = []
+        logreader.Filereader.initialized_log_files = set()
+
+    def begin_scan(self):
+        logreader.Filereader.initialized_log_files = set()
+        super().begin_scan()
+
+    # Read every active reader, yields (reader name, row). Each file is only read once, when several
+    # readers share a file (same path and range) every line goes to each of them in turn.
+    def read_rows(self):
+        active_readers = self.get_active()
+        groups = OrderedDict()
+        reads_alone = set()
+        for reader in active_readers:
+            reader_object = active_readers[reader]
+            # Readers with their own read(), or parsing in worker processes, read on their own
+            if isinstance(reader_object, logreader.Filereader) == False or type(reader_object).read is not logreader.Filereader.read or reader_object.read_workers() > 1:
+                reads_alone.add(reader)
+                groups[reader] = None
+                continue
+            for source in reader_object.sources:
+                if groups.get(source) is None:
+                    groups[source] = []
+                groups[source].append(reader_object)
+
+        for key in groups:
+            if groups[key] is None:
+                for row in active_readers[key].read():
+                    yield key, row
+            elif len(groups[key]) == 1:
+                reader_object = groups[key][0]
+                if reader_object.enabled:
+                    reader_name = reader_object.__class__.__name__
+                    for row in reader_object.read_source(key):
+                        yield reader_name, row
+            else:
+                yield from self.__read_shared(key, groups[key])
+
+        for reader in active_readers:
+            if reader in reads_alone:
+                continue
+            active_readers[reader].finish_read()
+
+    def __read_shared(self, source, readers):
+        # Lines none of the readers want are skipped before being decoded, if they all have prefilters
+        patterns = [r.prefilter_pattern for r in readers]
+        prefilters = (None, None)
+        if None not in patterns:
+            pattern = "|".join(sorted(set(patterns)))
+            prefilters = (re.compile(pattern), re.compile(pattern.encode()))
+
+        first = readers[0]
+        skipped_before = first.skip_count
+        own_skips = [0] * len(readers)
+        for line in first.filtered_lines(source, prefilters):
+            for i in range(len(readers)):
+                reader_object = readers[i]
+                if reader_object.enabled == False:
+                    continue
+                if reader_object.prefilter is not None and reader_object.prefilter.search(line) is None:
+                    own_skips[i] += 1
+                    continue
+                new_row = reader_object.parse_line(line)
+                if new_row is not None:
+                    yield reader_object.__class__.__name__, new_row
+
+        # Lines skipped by the combined prefilter count for every reader
+        skipped = first.skip_count - skipped_before
+        for i in range(len(readers)):
+            if i > 0:
+                readers[i].skip_count += skipped
+            readers[i].skip_count += own_skips[i]
 
 
 
@@ -117,8 +236,15 @@ class ReaderManager(ModuleManager):
 
 class MonitorManager(ModuleManager):
 
+    module_type = "monitor"
+
     def __init__(self, valid_readers=None):
         super().__init__()
+        self.routes = {}
+        self.route_counts = {}
+        self.shard_routes = {}
+        self.prefilters = {}
+        self.pool = None
         try:
             self.enabled_list = config.ENABLED_MONITORS
         except AttributeError:
@@ -139,7 +265,170 @@ class MonitorManager(ModuleManager):
                     active_monitors[module].enabled = True
                 else:
                     active_monitors[module].enabled = False
+                    self.disabled_on_load.add(module)
                     out.say("Module disabled: "+module+", no active readers.",2)
-    
 
+        if MONITOR_WORKERS > 1 and len(self.get_active()) > 1:
+            self.pool = monitorpool.get_pool(self, MONITOR_WORKERS)
+
+    def begin_scan(self):
+        if self.pool is not None:
+            self.pool.call("begin_scan")
+            self.pool.restart_failed()
+            return
+        super().begin_scan()
+
+    # Build a table of reader name -> active monitors using that reader, so each row is only
+    # handed to monitors that want it. Call at the start of a scan, after monitors are loaded.
+    def build_routes(self):
+        self.routes = {}
+        self.route_counts = {}
+        active_monitors = self.get_active()
+        for monitor in active_monitors:
+            readers = active_monitors[monitor].get_readers()
+            if readers is None:
+                continue
+            for reader in set(readers):
+                if self.routes.get(reader) is None:
+                    self.routes[reader] = []
+                self.routes[reader].append(active_monitors[monitor])
+
+        self.prefilters = {}
+        for reader in self.routes:
+            self.prefilters[reader] = self.__build_prefilter(self.routes[reader])
+
+        if self.pool is not None:
+            self.pool.call("build_routes")
+            self.shard_routes = {}
+            for reader in self.routes:
+                self.shard_routes[reader] = self.pool.shards_for(self.routes[reader])
+
+        for reader in self.routes:
+            self.route_counts[reader] = {
+                "monitors"  : len(self.routes[reader]),
+                "rows"      : 0,
+                "checks"    : 0
+            }
+
+    # Monitors can declare which lines they care about with a prefilter class variable, ex:
+    #   prefilter = {"substrings": ["Failed password"], "fields": {"user": ["root"]}, "event_ids": [4625, 4771]}
+    # A line is parsed if it contains any of the substrings, field values or event ids. Field values
+    # are matched anywhere in the raw line since it isn't parsed yet. If any monitor on a route has no
+    # prefilter, all lines are parsed for that reader.
+    def __build_prefilter(self, monitors):
+        patterns = []
+        for monitor in monitors:
+            try:
+                prefilter = monitor.prefilter
+            except AttributeError:
+                return None
+            if not prefilter:
+                return None
+            for substring in prefilter.get("substrings", []):
+                patterns.append(re.escape(substring))
+            fields = prefilter.get("fields", {})
+            for field in fields:
+                values = fields[field]
+                if type(values) not in (list, tuple, set):
+                    values = [values]
+                for value in values:
+                    patterns.append(re.escape(str(value)))
+            for event_id in prefilter.get("event_ids", []):
+                patterns.append("(?<![0-9])"+re.escape(str(event_id))+"(?![0-9])")
+
+        if len(patterns) == 0:
+            return None
+        # Longest first so the alternation doesn't stop on a shorter prefix
+        patterns = sorted(set(patterns), key=len, reverse=True)
+        return "|".join(patterns)
+
+    def get_prefilter(self, reader):
+        return self.prefilters.get(reader)
+
+    def get_route(self, reader):
+        return self.routes.get(reader, [])
+
+    def count_route(self, reader, rows):
+        if self.route_counts.get(reader) is None:
+            return
+        self.route_counts[reader]["rows"] += rows
+        self.route_counts[reader]["checks"] += rows * self.route_counts[reader]["monitors"]
+
+    # Hand every row read by a reader to the monitors routed to it
+    def check_rows(self, reader, rows):
+        self.check_tagged_rows((reader, row) for row in rows)
+
+    # Same as check_rows, for (reader name, row) from several readers (see ReaderManager.read_rows)
+    def check_tagged_rows(self, tagged_rows):
+        if self.pool is not None:
+            batch_size = MONITOR_BATCH_SIZE
+        else:
+            batch_size = CHECK_BATCH_SIZE
+        batches = {}
+        for reader, row in tagged_rows:
+            if row is None: continue
+            batch = batches.get(reader)
+            if batch is None:
+                batch = batches[reader] = []
+            batch.append(row)
+            if len(batch) >= batch_size:
+                self.__check_batch(reader, batch)
+                batches[reader] = []
+        for reader in batches:
+            if len(batches[reader]) > 0:
+                self.__check_batch(reader, batches[reader])
+
+    def __check_batch(self, reader, batch):
+        self.count_route(reader, len(batch))
+        if self.pool is not None:
+            for shard in self.shard_routes.get(reader, []):
+                self.pool.send_rows(shard, reader, batch)
+            return
+        for monitor in self.get_route(reader):
+            monitor.handle_check_batch(batch, reader)
+
+    def complete(self):
+        if self.pool is not None:
+            self.pool.call("complete")
+            return
+        active_monitors = self.get_active()
+        for monitor in active_monitors:
+            active_monitors[monitor].handle_complete()
+
+    def daily(self):
+        if self.pool is not None:
+            self.pool.call("daily")
+            return
+        active_monitors = self.get_active()
+        for monitor in active_monitors:
+            active_monitors[monitor].handle_daily()
+
+    def send_emails(self):
+        if self.pool is not None:
+            self.pool.call("send_emails")
+            return
+        active_monitors = self.get_active()
+        # All the monitors' emails go through one SMTP connection
+        out.begin_mail_batch()
+        try:
+            for monitor in active_monitors:
+                active_monitors[monitor].send_emails()
+        finally:
+            out.end_mail_batch()
+
+    def save_state(self, close=True):
+        if self.pool is not None:
+            self.pool.call("save_state", close)
+            return
+        active_monitors = self.get_active()
+        for monitor in active_monitors:
+            active_monitors[monitor].save_state(close)
+        # One commit for all the monitors when they share a db
+        logmonitor.commit_shared_db(close)
 
+    # Stop the worker processes, if any. keep_workers leaves them running for the next MonitorManager.
+    def close(self, keep_workers=False):
+        if self.pool is not None:
+            if keep_workers == False:
+                monitorpool.close_pool()
+            self.pool = None
@@ -0,0 +1,252 @@
+import os,sys
+import signal
+import traceback
+import multiprocessing
+sys.path.append(os.path.join(os.path.dirname(__file__), "../"))
+import config
+import output as out
+import logmonitor
+
+# Rows are sent to the workers in batches of this many
+try:
+    MONITOR_BATCH_SIZE = config.MONITOR_BATCH_SIZE
+except AttributeError:
+    MONITOR_BATCH_SIZE = 2000
+
+try:
+    DEBUG_MODULES = config.DEBUG_MODULES
+except AttributeError:
+    DEBUG_MODULES = False
+
+
+class MonitorPool:
+    # Splits the active monitors of a MonitorManager across forked worker processes. Each worker
+    # keeps a copy of the manager restricted to its own monitors, so the monitors' state, dstate and
+    # sqlstate only live (and are saved) in the worker. The copies left in the main process are only
+    # used for their names, enabled flag and check_count, which the workers report back.
+    # A worker that dies or fails takes its monitors out of the rest of the scan (with an error email
+    # like any other monitor error), it's started again with the monitors' saved state next scan.
+
+    def __init__(self, manager, workers):
+        self.manager = manager
+        self.names = list(manager.get_active().keys())
+        self.shards = [shard for shard in [self.names[i::workers] for i in range(workers)] if len(shard) > 0]
+        self.shard_of = {}
+        self.conns = [None] * len(self.shards)
+        self.processes = [None] * len(self.shards)
+        self.failed = set()
+
+        for i in range(len(self.shards)):
+            for name in self.shards[i]:
+                self.shard_of[name] = i
+        self.__close_dbs(self.names)
+        for i in range(len(self.shards)):
+            self.__start(i)
+        out.say("Monitors split across "+str(len(self.shards))+" worker processes: "+str(self.shards),2)
+
+    # Commit and close the monitors' dbs, so no connection is shared between processes. The workers
+    # open their own when the monitors next use their sqlstate.
+    def __close_dbs(self, names):
+        for name in names:
+            module = self.manager.loaded_modules.get(name)
+            if module is not None and module.sqlstate.db is not None:
+                module.sqlstate.close()
+        logmonitor.commit_shared_db(True)
+
+    def __start(self, shard):
+        # The worker would write out again whatever is still in the log buffers
+        out.flush()
+        context = multiprocessing.get_context("fork")
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(target=_shard_worker, args=(self.manager, self.shards[shard], child_conn), daemon=True)
+        process.start()
+        child_conn.close()
+        self.conns[shard] = parent_conn
+        self.processes[shard] = process
+
+    # Used for the next scan of a daemon that loads the monitors every scan (not PERSISTENT_DAEMON),
+    # the workers load their monitors again instead of being forked again. False if the monitors changed.
+    def attach(self, manager):
+        if list(manager.get_active().keys()) != self.names:
+            return False
+        self.manager = manager
+        self.__close_dbs(self.names)
+        self.call("reload_modules")
+        self.__restart_failed()
+        return True
+
+    # Workers that failed last scan are started again with their monitors loaded from the saved state
+    def restart_failed(self):
+        for shard in sorted(self.failed):
+            for name in self.shards[shard]:
+                if self.manager.loaded_modules.get(name) is not None:
+                    self.manager.reload_module(name)
+            self.__close_dbs(self.shards[shard])
+        self.__restart_failed()
+
+    def __restart_failed(self):
+        for shard in sorted(self.failed):
+            self.__start(shard)
+            out.say("Monitor worker process restarted for: "+", ".join(self.shards[shard]))
+        self.failed = set()
+
+    # Stop a worker that died or failed, and disable its monitors for the rest of the scan
+    def __fail(self, shard, method, detail):
+        if DEBUG_MODULES:
+            raise RuntimeError("Monitor worker process failed during "+method+":\n"+detail)
+        self.failed.add(shard)
+        try:
+            self.conns[shard].close()
+        except OSError:
+            pass
+        if self.processes[shard].is_alive():
+            self.processes[shard].kill()
+        self.processes[shard].join(60)
+
+        names = self.shards[shard]
+        msg = "ERROR: The monitor worker process for "+", ".join(names)+" failed during "+method+", "
+        msg += "these monitors are disabled until the next scan.\n"+detail
+        out.say(msg)
+        out.error(msg)
+        email_to = []
+        for name in names:
+            module = self.manager.loaded_modules.get(name)
+            if module is None:
+                continue
+            module.enabled = False
+            module.errors.append(msg)
+            if module.EMAIL_ERRORS_TO not in email_to:
+                email_to.append(module.EMAIL_ERRORS_TO)
+        for to in email_to:
+            out.send_email(config.ERRORS_FROM_ADDRESS, to, "Monitor worker failed: "+", ".join(names), msg)
+
+    # Shard numbers with at least one monitor in the route
+    def shards_for(self, monitors):
+        shards = set()
+        for monitor in monitors:
+            shard = self.shard_of.get(monitor.__class__.__name__)
+            if shard is not None:
+                shards.add(shard)
+        return sorted(shards)
+
+    def send_rows(self, shard, reader, rows):
+        if shard in self.failed:
+            return
+        try:
+            self.conns[shard].send(("rows", reader, rows))
+        except OSError as e:
+            self.__fail(shard, "check_rows", "Worker process exited: "+str(e))
+
+    # Run a MonitorManager method in every worker, then copy back each monitor's status
+    def call(self, method, *args):
+        for shard in range(len(self.shards)):
+            if shard in self.failed:
+                continue
+            try:
+                self.conns[shard].send(("call", method, args))
+            except OSError as e:
+                self.__fail(shard, method, "Worker process exited: "+str(e))
+
+        results = []
+        for shard in range(len(self.shards)):
+            if shard in self.failed:
+                continue
+            try:
+                status, result, error = self.conns[shard].recv()
+            except (EOFError, OSError):
+                self.__fail(shard, method, "Worker process exited, exit code "+str(self.processes[shard].exitcode))
+                continue
+            if error is not None:
+                self.__fail(shard, method, error)
+                continue
+            for name in status:
+                module = self.manager.loaded_modules.get(name)
+                if module is None:
+                    continue
+                module.enabled = status[name]["enabled"]
+                module.check_count = status[name]["check_count"]
+            results.append(result)
+        return results
+
+    def close(self):
+        for shard in range(len(self.shards)):
+            if shard in self.failed:
+                continue
+            try:
+                self.conns[shard].send(("stop",))
+            except OSError:
+                pass
+        for process in self.processes:
+            process.join(60)
+        self.conns = []
+        self.processes = []
+
+pool = None
+
+# The pool left running by the last MonitorManager (see MonitorManager.close) is used again when it
+# has the same monitors
+def get_pool(manager, workers):
+    global pool
+    if pool is not None and pool.attach(manager):
+        return pool
+    close_pool()
+    pool = MonitorPool(manager, workers)
+    return pool
+
+def close_pool():
+    global pool
+    if pool is not None:
+        pool.close()
+        pool = None
+
+
+def _shard_worker(manager, names, conn):
+    # The main process handles shutdown and tells the workers when to save and stop
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    manager.pool = None
+    for name in list(manager.loaded_modules.keys()):
+        if name not in names:
+            del(manager.loaded_modules[name])
+
+    error = None
+    while True:
+        msg = conn.recv()
+        if msg[0] == "stop":
+            # The worker exits without running atexit, write out what it logged
+            out.flush()
+            break
+
+        if msg[0] == "rows":
+            # No reply for rows, an error is held until the next call
+            if error is not None:
+                continue
+            try:
+                manager.check_rows(msg[1], msg[2])
+                # Workers share the db file, don't keep it locked while waiting for more rows
+                logmonitor.commit_shared_db()
+            except BaseException:
+                error = traceback.format_exc()
+            continue
+
+        result = None
+        if error is None:
+            try:
+                result = getattr(manager, msg[1])(*msg[2])
+                # Same as after rows, monitors can write in complete() and the other hooks
+                logmonitor.commit_shared_db()
+            except BaseException:
+                error = traceback.format_exc()
+
+        status = {}
+        for name in manager.loaded_modules:
+            status[name] = {
+                "enabled"       : manager.loaded_modules[name].enabled,
+                "check_count"   : manager.loaded_modules[name].check_count
+            }
+        # Logged by the monitors during the call (and emails sent), written before the main process goes on
+        out.flush()
+        conn.send((status, result, error))
+        error = None
+    conn.close()
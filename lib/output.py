@@ -1,5 +1,9 @@
 import os,sys
 import datetime
+import time
+import queue
+import threading
+import atexit
 import smtplib
 from email.mime.text import MIMEText
 import email
@@ -12,25 +16,345 @@ try:
 except AttributeError:
     DEBUG_MODULES = False
 
+# Log lines (and daemon stdout) are handed to a writer thread that keeps the files open and
+# flushes them every LOG_FLUSH_LINES lines or LOG_FLUSH_INTERVAL seconds. False writes each line
+# straight to the file like before.
+try:
+    LOG_BUFFERED = config.LOG_BUFFERED
+except AttributeError:
+    LOG_BUFFERED = True
+
+# Lines waiting for the writer thread, log calls wait when it's full
+try:
+    LOG_QUEUE_SIZE = config.LOG_QUEUE_SIZE
+except AttributeError:
+    LOG_QUEUE_SIZE = 10000
+
+try:
+    LOG_FLUSH_LINES = config.LOG_FLUSH_LINES
+except AttributeError:
+    LOG_FLUSH_LINES = 1000
+
+try:
+    LOG_FLUSH_INTERVAL = config.LOG_FLUSH_INTERVAL
+except AttributeError:
+    LOG_FLUSH_INTERVAL = 1
+
+
+class LogWriter:
+    # Writes (path, line) records from the queue, path None is stdout. Files are checked after each
+    # flush and reopened if they were moved or deleted (logrotate). The queue holds LOG_QUEUE_SIZE
+    # records, writing waits for room. Signal handlers can't wait on it, they use say_now().
+
+    FLUSH = object()
+    REOPEN = object()
+    STOP = object()
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.files = {}
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self.run, name="output", daemon=True)
+        self.thread.start()
+
+    # Lines are dropped if the thread is gone, nothing would ever make room for them
+    def put(self, record):
+        while self.thread.is_alive():
+            try:
+                self.queue.put(record, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def write(self, path, line):
+        self.put((path, line))
+
+    # Returns once everything queued before it is written and flushed, or right away if the thread is gone
+    def flush(self):
+        done = threading.Event()
+        if self.put((self.FLUSH, done)) == False:
+            return
+        while done.wait(1) == False:
+            if self.thread.is_alive() == False:
+                return
+
+    def reopen(self):
+        self.put((self.REOPEN, None))
+
+    # Write out and close everything, then end the thread
+    def stop(self):
+        if self.put((self.STOP, None)):
+            self.thread.join()
+
+    def run(self):
+        pending = 0
+        last_flush = time.time()
+        while True:
+            # Nothing to flush, wait for the next record however long it takes
+            timeout = None
+            if pending > 0:
+                timeout = max(0, last_flush + LOG_FLUSH_INTERVAL - time.time())
+            try:
+                path, line = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                path = None
+                line = None
+
+            if path is self.STOP:
+                self.__flush_files()
+                self.__close_files()
+                return
+            if path is self.FLUSH:
+                try:
+                    self.__flush_files()
+                finally:
+                    line.set()
+                pending = 0
+                last_flush = time.time()
+                continue
+            if path is self.REOPEN:
+                self.__close_files()
+                continue
+            if line is not None:
+                self.__write(path, line)
+                pending += 1
+
+            if pending > 0 and (pending >= LOG_FLUSH_LINES or time.time() - last_flush >= LOG_FLUSH_INTERVAL):
+                self.__flush_files()
+                pending = 0
+                last_flush = time.time()
+
+    def __write(self, path, line):
+        try:
+            if path is None:
+                sys.stdout.write(line)
+                return
+            f = self.files.get(path)
+            if f is None:
+                f = open(path, 'a')
+                self.files[path] = f
+            f.write(line)
+        # Anything, the thread has to keep running or every flush would wait on it
+        except Exception as e:
+            sys.stderr.write("Can't write to "+str(path)+": "+str(e)+"\n")
+
+    def __flush_files(self):
+        try:
+            sys.stdout.flush()
+        except Exception:
+            pass
+        for path in list(self.files.keys()):
+            f = self.files[path]
+            try:
+                f.flush()
+                # Rotated away, open the new file on the next write
+                stat = os.stat(path)
+                fstat = os.fstat(f.fileno())
+                if stat.st_ino == fstat.st_ino and stat.st_dev == fstat.st_dev:
+                    continue
+            except Exception:
+                pass
+            self.__close(path)
+
+    def __close_files(self):
+        for path in list(self.files.keys()):
+            self.__close(path)
+
+    def __close(self, path):
+        try:
+            self.files[path].close()
+        except Exception:
+            pass
+        del(self.files[path])
+
+writer = None
+
+def get_writer():
+    global writer
+    # A forked child doesn't have the parent's thread, it starts its own (so does a writer whose thread died)
+    if writer is None or writer.pid != os.getpid() or writer.thread.is_alive() == False:
+        writer = LogWriter()
+    return writer
+
+def write(path, line):
+    if LOG_BUFFERED:
+        get_writer().write(path, line)
+    elif path is None:
+        sys.stdout.write(line)
+        if config.daemon:
+            sys.stdout.flush()
+    else:
+        with open (path,'a') as f:
+            f.write(line)
+
+# Write out everything logged so far, called at the end of each scan and when exiting
+def flush():
+    if writer is not None and writer.pid == os.getpid():
+        writer.flush()
+
+# Close the log files so they're opened again on the next line, after they've been rotated
+def reopen():
+    if writer is not None and writer.pid == os.getpid():
+        writer.reopen()
+
+def forget_writer():
+    global writer
+    writer = None
+
+# Stop the writer thread once everything is written, when exiting
+def stop_writer():
+    global writer
+    if writer is not None and writer.pid == os.getpid():
+        writer.stop()
+        writer = None
+
+atexit.register(stop_writer)
+# A forked child starts its own writer. Flush before forking (see MonitorPool, Filereader workers),
+# anything left in the file buffers would be written again by the child.
+os.register_at_fork(after_in_child=forget_writer)
+
+# For runs without a SIGTERM handler of their own, exit normally so the logs are flushed
+def exit_on_sigterm(signum, frame):
+    sys.exit(128 + signum)
+
 def log(text, verbose=0):
     if verbose <= config.args.verbose:
-        with open (config.RUNLOG_PATH,'a') as f:
-            f.write(datetime.datetime.now().isoformat()+' '+text+'\n')
+        write(config.RUNLOG_PATH, datetime.datetime.now().isoformat()+' '+text+'\n')
 
 def debug(text):
-    with open (config.DEBUGLOG_PATH,'a') as f:
-        f.write(datetime.datetime.now().isoformat()+' '+text+'\n')
+    write(config.DEBUGLOG_PATH, datetime.datetime.now().isoformat()+' '+text+'\n')
 
 def say(text, verbose=0):
     if verbose <= config.args.verbose:
-        print(datetime.datetime.now().isoformat()+' '+text)
         if config.daemon:
-            sys.stdout.flush()
+            # stdout is flushed by the writer, not on every line
+            write(None, datetime.datetime.now().isoformat()+' '+text+'\n')
+        else:
+            print(datetime.datetime.now().isoformat()+' '+text)
 
 def error(text):
-    with open (config.ERRORLOG_PATH,'a') as f:
-        f.write(datetime.datetime.now().isoformat()+' '+text+'\n')
+    write(config.ERRORLOG_PATH, datetime.datetime.now().isoformat()+' '+text+'\n')
+
+# For signal handlers, the code they interrupted may be holding the log queue's lock.
+# Goes straight to stdout, ahead of any lines still queued.
+def say_now(text):
+    try:
+        os.write(sys.stdout.fileno(), (datetime.datetime.now().isoformat()+' '+text+'\n').encode())
+    except (OSError, ValueError):
+        pass
+
+
+
+# Seconds to wait on the mail server before giving up on a message
+try:
+    SMTP_TIMEOUT = config.SMTP_TIMEOUT
+except AttributeError:
+    SMTP_TIMEOUT = 30
+
+# During a mail batch the connection is reused for this many messages, then opened again
+try:
+    SMTP_BATCH_SIZE = config.SMTP_BATCH_SIZE
+except AttributeError:
+    SMTP_BATCH_SIZE = 100
+
+
+class SMTPSession(smtplib.SMTP):
+    # Remembers if the message was handed over, after DATA the server may have it already
+    data_sent = False
+
+    def data(self, msg):
+        self.data_sent = True
+        return super().data(msg)
+
+
+class MailTransport:
+    # Keeps an SMTP session open between messages while a batch is going (begin_mail_batch), outside
+    # of one every message gets its own connection. A reused connection the server dropped before DATA
+    # is opened again once, nothing is retried after DATA so a message is never sent twice. When the
+    # server can't be reached it isn't tried again until the next scan (reset_mail_server).
+
+    def __init__(self, server):
+        self.server = server
+        self.session = None
+        self.sent = 0
+        self.batch = False
+        self.down = None
+
+    def connect(self):
+        if self.down is not None:
+            raise smtplib.SMTPConnectError(-1, "Mail server "+self.server+" is down, not trying again this scan ("+self.down+")")
+        if self.session is None or self.sent >= SMTP_BATCH_SIZE:
+            self.close()
+            try:
+                self.session = SMTPSession(self.server, timeout=SMTP_TIMEOUT)
+            except (smtplib.SMTPException, OSError) as e:
+                self.down = str(e)
+                raise
+            self.sent = 0
+        self.session.data_sent = False
+        return self.session
+
+    # send is a function taking the smtplib.SMTP session
+    def send(self, send):
+        try:
+            reused = self.session is not None and self.sent < SMTP_BATCH_SIZE
+            session = self.connect()
+            try:
+                send(session)
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+                raise
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                self.drop()
+                if reused == False or session.data_sent:
+                    raise
+                send(self.connect())
+            except (smtplib.SMTPException, OSError):
+                self.drop()
+                raise
+            self.sent += 1
+        finally:
+            if self.batch == False:
+                self.close()
+
+    def close(self):
+        if self.session is not None:
+            try:
+                self.session.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.drop()
+
+    # Forget a broken connection without talking to the server
+    def drop(self):
+        if self.session is not None:
+            try:
+                self.session.close()
+            except OSError:
+                pass
+        self.session = None
+
+transport = None
+
+def get_transport():
+    global transport
+    if transport is None or transport.server != config.MAILSERVER:
+        transport = MailTransport(config.MAILSERVER)
+    return transport
+
+# Reuse one SMTP connection for the emails sent until end_mail_batch
+def begin_mail_batch():
+    get_transport().batch = True
+
+def end_mail_batch():
+    if transport is not None:
+        transport.batch = False
+        transport.close()
 
+# Try a mail server that was down again, called when a scan begins
+def reset_mail_server():
+    if transport is not None:
+        transport.down = None
 
 
 def send_email(email_from, email_to, email_subject, email_body, bcc=None):
@@ -66,9 +390,7 @@ def send_email(email_from, email_to, email_subject, email_body, bcc=None):
         msg.set_payload(email_body)
 
         try:
-            mailserver = smtplib.SMTP(config.MAILSERVER)
-            mailserver.sendmail(msg['From'],msg['To'].split(","), msg.as_string().encode('utf-8'))
-            mailserver.quit()
+            get_transport().send(lambda mailserver: mailserver.sendmail(msg['From'],msg['To'].split(","), msg.as_string().encode('utf-8')))
             return True
         except BaseException as e:
             if DEBUG_MODULES:
@@ -119,6 +441,4 @@ def send_email_mime(email_from, email_to, email_subject, email_body, bcc=None):
             else:
                 msg['Bcc'] = ",".join(bcc)
 
-        mailserver = smtplib.SMTP(config.MAILSERVER)
-        mailserver.send_message(msg)
-        mailserver.quit()
\ No newline at end of file
+        get_transport().send(lambda mailserver: mailserver.send_message(msg))
\ No newline at end of file
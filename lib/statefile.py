@@ -0,0 +1,81 @@
+import os,sys
+import json
+import zlib
+sys.path.append(os.path.join(os.path.dirname(__file__), "../"))
+import config
+
+# State files (scan state, readers, monitors) start with a header line: MAGIC, the format version and
+# the encoding of the rest of the file. Files without the header are the old indented json and are
+# loaded as that, they're written in the new format the next time they're saved.
+
+MAGIC = b"LOGALERTS-STATE"
+VERSION = 1
+
+# Encoding used when saving: "json" (compact json), "zlib" (compressed compact json)
+# or "pretty" (the old indented json without a header, easy to read and edit by hand)
+try:
+    STATE_FORMAT = config.STATE_FORMAT
+except AttributeError:
+    STATE_FORMAT = "json"
+
+try:
+    STATE_COMPRESS_LEVEL = config.STATE_COMPRESS_LEVEL
+except AttributeError:
+    STATE_COMPRESS_LEVEL = 1
+
+
+def encode_json(data):
+    return json.dumps(data, separators=(",", ":")).encode()
+
+def decode_json(payload):
+    return json.loads(payload)
+
+def encode_zlib(data):
+    return zlib.compress(encode_json(data), STATE_COMPRESS_LEVEL)
+
+def decode_zlib(payload):
+    return json.loads(zlib.decompress(payload))
+
+# name: (encode, decode)
+ENCODINGS = {
+    "json"  : (encode_json, decode_json),
+    "zlib"  : (encode_zlib, decode_zlib)
+}
+
+
+# Raises FileNotFoundError if there is no state file yet
+def load(path):
+    with open(path, "rb") as f:
+        content = f.read()
+
+    if content.startswith(MAGIC) == False:
+        return json.loads(content)
+
+    end = content.index(b"\n")
+    header = content[:end].decode().split(" ")
+    version = int(header[1])
+    if version > VERSION:
+        raise ValueError(path+" was saved by a newer version (state format "+str(version)+")")
+    encoding = ENCODINGS.get(header[2])
+    if encoding is None:
+        raise ValueError(path+" has an unknown state encoding: "+header[2])
+    return encoding[1](content[end+1:])
+
+
+# Written to a temp file that replaces the old one, so a crash never leaves a half written state file
+def save(path, data, encoding=None):
+    if encoding is None:
+        encoding = STATE_FORMAT
+
+    if encoding == "pretty":
+        content = json.dumps(data, indent=4).encode()
+    else:
+        header = MAGIC+b" "+str(VERSION).encode()+b" "+encoding.encode()+b"\n"
+        content = header+ENCODINGS[encoding][0](data)
+
+    temp_path = path+".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
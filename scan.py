@@ -4,14 +4,18 @@ if sys.version_info < (3, 0):
     sys.exit()
 import signal
 import argparse
-import json
 import datetime
 import time
 import config
 import subprocess
 from lib.modulemanager import ReaderManager
 from lib.modulemanager import MonitorManager
-import lib.output as out
+from lib.logwatcher import LogWatcher
+# Same module the lib modules import as output, so everything goes through one log writer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "lib"))
+import output as out
+import statefile
+import monitorpool
 
 SIGTERM = False
 
@@ -23,7 +27,43 @@ DEBUGLOG = config.DEBUGLOG_PATH
 
 DAEMON_INTERVAL = config.DAEMON_INTERVAL
 
+# Keep readers and monitors (and their state) loaded between scans when running as a daemon
+try:
+    PERSISTENT_DAEMON = config.PERSISTENT_DAEMON
+except AttributeError:
+    PERSISTENT_DAEMON = False
+
+# Seconds between saving reader/monitor state to disk in persistent mode
+try:
+    STATE_CHECKPOINT_INTERVAL = config.STATE_CHECKPOINT_INTERVAL
+except AttributeError:
+    STATE_CHECKPOINT_INTERVAL = 300
+
+# Use inotify to start daemon scans when log files are written, instead of every DAEMON_INTERVAL
+try:
+    DAEMON_INOTIFY = config.DAEMON_INOTIFY
+except AttributeError:
+    DAEMON_INOTIFY = False
+
+try:
+    DAEMON_DEBOUNCE = config.DAEMON_DEBOUNCE
+except AttributeError:
+    DAEMON_DEBOUNCE = 2
+
+try:
+    DAEMON_MAX_LATENCY = config.DAEMON_MAX_LATENCY
+except AttributeError:
+    DAEMON_MAX_LATENCY = 10
+
+try:
+    DAEMON_IDLE_INTERVAL = config.DAEMON_IDLE_INTERVAL
+except AttributeError:
+    DAEMON_IDLE_INTERVAL = 600
+
 state = None
+reader_manager = None
+monitor_manager = None
+last_checkpoint = 0
 
 def main():
     global state
@@ -44,87 +84,158 @@ def run_daemon():
     args.verbose = max(1, args.verbose)
     next_run = 0
     out.say("Daemon starting.")
+    watcher = start_watcher()
     while daemonStatus.active:
         # This allows checking for shutdown signals if between scans
-        if next_run > int(time.time()):
+        if watcher is not None:
+            if watcher.ready(timeout=1) == False:
+                continue
+            watcher.scanned()
+        elif next_run > int(time.time()):
             time.sleep(1)
             continue
 
         next_run = int(time.time())+DAEMON_INTERVAL
         out.say("Starting scan: "+datetime.datetime.now().isoformat())
         start_time = time.time()
-        sys.stdout.flush()
+        out.flush()
         scan()
         run_time = int(time.time() - start_time)
         msg = "Scan completed in "+str(run_time)+" seconds."
         out.log(msg); out.say(msg,1)
-        sys.stdout.flush()
+        out.flush()
         # Break here if inactive to make us look smarter
         if daemonStatus.active == False:
             break
         
+        if watcher is not None:
+            out.say("(Next scan starts when logs are written, or by "+str(datetime.datetime.fromtimestamp(int(time.time())+DAEMON_IDLE_INTERVAL))+")\n")
+            out.flush()
+            continue
+
         sleep_time = max(0,next_run - int(time.time()))
         out.say("(Next scan starts at "+str(datetime.datetime.fromtimestamp(next_run))+")\n")
-        sys.stdout.flush()
+        out.flush()
+
+    if watcher is not None:
+        watcher.close()
+
+    # State is only checkpointed every so often in persistent mode, make sure the last of it is saved
+    if persistent() and monitor_manager is not None:
+        out.say("Saving state before quitting.")
+        save_module_states(close=True)
+    monitorpool.close_pool()
+    out.flush()
+
+
+def start_watcher():
+    if DAEMON_INOTIFY == False:
+        return None
+
+    log_files = []
+    try:
+        for reader in config.ENABLED_READERS:
+            log_files += config.ENABLED_READERS[reader].get("files") or []
+    except AttributeError:
+        pass
+
+    try:
+        watcher = LogWatcher(log_files, DAEMON_DEBOUNCE, DAEMON_MAX_LATENCY, DAEMON_IDLE_INTERVAL)
+    except (OSError, AttributeError) as e:
+        out.say("inotify not available, falling back to scanning every "+str(DAEMON_INTERVAL)+" seconds: "+str(e))
+        return None
+    out.say("Watching for log activity in: "+", ".join(watcher.patterns.keys()))
+    return watcher
+
+
+def persistent():
+    return args.daemon and PERSISTENT_DAEMON
 
 
 def scan():
-    
+    global reader_manager, monitor_manager, last_checkpoint
+
     out.log("Started")
     state.data["last_run_start"] = int(time.time())
 
-    reader_manager = ReaderManager()
-    monitor_manager = MonitorManager(valid_readers=reader_manager.get_active().keys())
+    if persistent() and monitor_manager is not None:
+        reader_manager.begin_scan()
+        monitor_manager.begin_scan()
+    else:
+        reader_manager = ReaderManager()
+        monitor_manager = MonitorManager(valid_readers=reader_manager.get_active().keys())
 
-    # First move log files and HUP rsyslog
+    # First move log files and HUP rsyslog (not needed if all readers tail the files in place)
     active_readers = reader_manager.get_active()
+    needs_hup = False
     for reader in active_readers:
         active_readers[reader].initialize()
+        if active_readers[reader].needs_hup:
+            needs_hup = True
 
-    subprocess.call(config.SYSLOG_HUP_CMD, shell=True)
+    if needs_hup:
+        subprocess.call(config.SYSLOG_HUP_CMD, shell=True)
 
     # Run checks for all monitors (bulk of the work is here)
     active_readers = reader_manager.get_active()
     active_monitors = monitor_manager.get_active()
     out.say("Active readers: "+str(active_readers.keys()),1)
     out.say("Active monitors: "+str(active_monitors.keys()),1)
+    monitor_manager.build_routes()
     for reader in active_readers:
-        for row in active_readers[reader].read():
-            if row is None: continue
-            for monitor in active_monitors:
-                active_monitors[monitor].handle_check(row, reader)
+        active_readers[reader].set_prefilter(monitor_manager.get_prefilter(reader))
+    monitor_manager.check_tagged_rows(reader_manager.read_rows())
 
     # Call complete function on all monitors (logs are complete)
-    active_monitors = monitor_manager.get_active()
-    for monitor in active_monitors:
-        active_monitors[monitor].handle_complete()
+    monitor_manager.complete()
 
     # Call daily function on all monitors (in case you have a daily thing)
     if run_daily_ok() or args.force_daily:
-        active_monitors = monitor_manager.get_active()
-        for monitor in active_monitors:
-            active_monitors[monitor].handle_daily()
+        monitor_manager.daily()
         run_daily_completed()
         
     # Send all queued emails
-    active_monitors = monitor_manager.get_active()
-    for monitor in active_monitors:
-        active_monitors[monitor].send_emails()
+    monitor_manager.send_emails()
 
     # Run cleanup on all the readers (delete temp files, etc)
     active_readers = reader_manager.get_active()
     for reader in active_readers:
         active_readers[reader].cleanup()
-        active_readers[reader].save_state()
-        out.log(reader+" - read "+str(active_readers[reader].read_count)+" log lines.")
+        msg = reader+" - read "+str(active_readers[reader].read_count)+" log lines."
+        if active_readers[reader].skip_count > 0:
+            msg += " ("+str(active_readers[reader].skip_count)+" skipped by prefilter)"
+        out.log(msg)
 
-    # Save state data for all monitors
+    active_monitors = monitor_manager.get_active()
     for monitor in active_monitors:
-        active_monitors[monitor].save_state()
         out.log(monitor+" checked "+str(active_monitors[monitor].check_count)+" lines.",1)
 
+    for reader in monitor_manager.route_counts:
+        counts = monitor_manager.route_counts[reader]
+        out.log("Route "+reader+" -> "+str(counts["monitors"])+" monitors, "+str(counts["rows"])+" rows, "+str(counts["checks"])+" checks.",1)
+
+    # Save state data for all readers and monitors, in persistent mode only every STATE_CHECKPOINT_INTERVAL
+    if persistent() == False:
+        # A daemon keeps the monitor workers for the next scan's monitors
+        save_module_states(close=True, keep_workers=args.daemon and daemonStatus.active)
+    elif last_checkpoint + STATE_CHECKPOINT_INTERVAL <= int(time.time()):
+        save_module_states(close=False)
+        last_checkpoint = int(time.time())
+        out.say("State checkpoint saved.",1)
+
     state.data["last_run_complete"] = int(time.time())
     state.save()
+    out.flush()
+
+
+def save_module_states(close=True, keep_workers=False):
+    active_readers = reader_manager.get_active()
+    for reader in active_readers:
+        active_readers[reader].save_state()
+
+    monitor_manager.save_state(close)
+    if close:
+        monitor_manager.close(keep_workers)
 
 # Logic for when to run daily things
 def run_daily_ok():
@@ -158,14 +269,12 @@ class StateData:
 
     def __load(self):
         try:
-            with open(self.file_path) as f:
-                self.data = json.load(f)
+            self.data = statefile.load(self.file_path)
         except FileNotFoundError:
             self.__initstate()
 
     def save(self):
-        with open(self.file_path,"w") as f:
-            json.dump(self.data,f, indent=4)
+        statefile.save(self.file_path, self.data)
 
     # I realize there is a race condition here, trying twice to make it less likely
     def pid_lock(self):
@@ -196,7 +305,7 @@ class DaemonStatus():
 
     def terminate(self, a, b):
         self.killtime = int(time.time())+60
-        out.say("Finishing current scan before quitting, allowing "+str(self.gracetimeleft())+" seconds.")
+        out.say_now("Finishing current scan before quitting, allowing "+str(self.gracetimeleft())+" seconds.")
         self.active = False
         
     def gracetimeleft(self):
@@ -215,5 +324,7 @@ if __name__ == '__main__':
 
     if args.daemon:
         daemonStatus = DaemonStatus()
+    else:
+        signal.signal(signal.SIGTERM, out.exit_on_sigterm)
 
     main()
\ No newline at end of file
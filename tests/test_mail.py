@@ -0,0 +1,146 @@
+import os,sys
+import socket
+import socketserver
+import threading
+import time
+import types
+import unittest
+import smtplib
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../lib"))
+# output only needs a few settings, the tests don't use a real config.py
+if "config" not in sys.modules:
+    sys.modules["config"] = types.ModuleType("config")
+import output as out
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    # Just enough SMTP for smtplib. The server's mode decides how it misbehaves:
+    # "ok", "close_after_data" (hangs up after reading the message instead of replying) or
+    # "close_after_message" (hangs up before the next message on the connection)
+
+    def reply(self, line):
+        self.wfile.write((line+"\r\n").encode())
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.reply("220 test")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.decode().strip().upper()
+            if cmd.startswith("EHLO") or cmd.startswith("HELO"):
+                self.reply("250 test")
+            elif cmd.startswith("MAIL") or cmd.startswith("RCPT") or cmd.startswith("RSET"):
+                self.reply("250 ok")
+            elif cmd == "DATA":
+                self.reply("354 go ahead")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                server.messages += 1
+                if server.mode == "close_after_data":
+                    return
+                self.reply("250 queued")
+                if server.mode == "close_after_message":
+                    return
+            elif cmd == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("502 no")
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mode):
+        super().__init__(("127.0.0.1", 0), SMTPHandler)
+        self.mode = mode
+        self.connections = 0
+        self.messages = 0
+
+
+def sendmail(session):
+    session.sendmail("from@example.com", ["to@example.com"], b"Subject: test\r\n\r\nbody\r\n")
+
+
+class MailTransportTest(unittest.TestCase):
+
+    def start(self, mode):
+        server = SMTPServer(mode)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, "127.0.0.1:"+str(server.server_address[1])
+
+    def test_batch_reuses_connection(self):
+        server, address = self.start("ok")
+        transport = out.MailTransport(address)
+        transport.batch = True
+        for i in range(3):
+            transport.send(sendmail)
+        transport.batch = False
+        transport.close()
+        self.assertEqual(server.messages, 3)
+        self.assertEqual(server.connections, 1)
+
+    def test_reconnects_when_dropped_before_data(self):
+        server, address = self.start("close_after_message")
+        transport = out.MailTransport(address)
+        transport.batch = True
+        transport.send(sendmail)
+        time.sleep(0.1)
+        transport.send(sendmail)
+        transport.batch = False
+        transport.close()
+        self.assertEqual(server.messages, 2)
+        self.assertEqual(server.connections, 2)
+
+    def test_no_retry_after_data(self):
+        server, address = self.start("close_after_data")
+        transport = out.MailTransport(address)
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            transport.send(sendmail)
+        self.assertEqual(server.messages, 1)
+        self.assertEqual(server.connections, 1)
+
+    def test_dead_server_fails_fast(self):
+        # Accepts the connection but never answers, like a hung relay
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(5)
+        self.addCleanup(listener.close)
+        address = "127.0.0.1:"+str(listener.getsockname()[1])
+
+        timeout = out.SMTP_TIMEOUT
+        out.SMTP_TIMEOUT = 0.5
+        self.addCleanup(setattr, out, "SMTP_TIMEOUT", timeout)
+
+        transport = out.MailTransport(address)
+        transport.batch = True
+        start = time.time()
+        with self.assertRaises(OSError):
+            transport.send(sendmail)
+        self.assertGreaterEqual(time.time() - start, 0.5)
+
+        start = time.time()
+        for i in range(5):
+            with self.assertRaises(smtplib.SMTPConnectError):
+                transport.send(sendmail)
+        self.assertLess(time.time() - start, 0.1)
+
+        # Tried again on the next scan
+        out.transport = transport
+        self.addCleanup(setattr, out, "transport", None)
+        out.reset_mail_server()
+        with self.assertRaises(OSError):
+            transport.send(sendmail)
+        self.assertIsNotNone(transport.down)
+
+
+if __name__ == "__main__":
+    unittest.main()